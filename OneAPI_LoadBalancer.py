@@ -1,102 +1,2320 @@
+import os
+import re
+import json
 import time
+import heapq
+import bisect
+import copy
+import math
 import random
+import hashlib
+import mmap
+import email.utils
+import sqlite3
+import functools
+import itertools
+import contextlib
+import concurrent.futures
 import asyncio
 import aiohttp
+import argparse
 import logging
-from collections import deque
+import logging.handlers
+import queue
+import atexit
+from collections import deque, OrderedDict
 import tiktoken
+from aiohttp import web
 
-# 设置日志配置，将日志等级设置为 DEBUG 以记录详细信息
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+try:
+    import fcntl  # 共享内存限流后端的文件锁，仅 POSIX 系统可用
+except ImportError:
+    fcntl = None
+
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')  # 限流响应头中的时长格式，如 6m0s、20ms
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+CLIENT_ERROR_STATUSES = (400, 413, 422)  # 上游认为请求本身有误（参数错误、超出上下文长度等），换目标重试同样会失败
+
+logger = logging.getLogger('oneapi_lb')
+
+# LogRecord 的标准属性，其余属性视为通过 extra 传入的结构化字段
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+_log_listener = None
+
+
+class TextLogFormatter(logging.Formatter):
+    """
+    文本日志格式，采样抑制过日志时在消息末尾注明被抑制的条数
+    """
+
+    def format(self, record):
+        message = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{message} ({suppressed} similar messages suppressed)' if suppressed else message
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    结构化日志格式：每条日志输出为一行 JSON，extra 传入的字段（如 target、reason）作为独立键
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogSampler(logging.Filter):
+    """
+    重复日志采样：同一模板与参数的日志在 interval 秒内只输出一次，
+    下一次输出时附带期间被抑制的条数。只对 max_level 及以下等级生效。
+    """
+
+    def __init__(self, interval=10, max_level=logging.WARNING):
+        """
+        :param interval: 同类日志的最短输出间隔（秒），0 表示不采样
+        :param max_level: 参与采样的最高日志等级，更高等级的日志总是输出
+        """
+        super().__init__()
+        self.interval = interval
+        self.max_level = max_level
+        self.seen = {}  # {(等级, 模板, 参数): [下一次允许输出的时间, 被抑制的条数]}
+
+    def filter(self, record):
+        if not self.interval or record.levelno > self.max_level:
+            return True
+        try:
+            key = (record.levelno, record.msg, record.args)
+            state = self.seen.get(key)
+        except TypeError:  # 参数不可哈希时不采样
+            return True
+        current_time = time.monotonic()
+        if state is not None and current_time < state[0]:
+            state[1] += 1
+            return False
+        if state is not None and state[1]:
+            record.suppressed = state[1]
+        if len(self.seen) >= 10000:
+            self.seen.clear()
+        self.seen[key] = [current_time + self.interval, 0]
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    把原始日志记录放入队列，保留 msg、args 与 exc_info，消息拼接与异常格式化都交给后台线程完成
+    （标准 QueueHandler 在发出日志的线程中格式化记录并清除 exc_info）
+    """
+
+    def prepare(self, record):
+        return copy.copy(record)  # 浅拷贝，避免其他处理器看到后台线程对记录的修改
+
+
+def _stop_log_listener():
+    """停止后台日志线程并写出队列中剩余的日志"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def configure_logging(level='INFO', fmt='text', sample_interval=10, stream=None):
+    """
+    配置日志输出：原始日志记录经 DeferredQueueHandler 放入队列，由后台线程的 QueueListener 格式化并写出，
+    事件循环中不做 I/O；重复的警告按 sample_interval 采样。只应由应用入口调用，导入本模块不会改变日志配置。
+    :param level: 日志等级名或数值
+    :param fmt: 'text'（文本）或 'json'（每行一个 JSON 对象）
+    :param sample_interval: 同类 WARNING 及以下日志的最短输出间隔（秒），0 表示不采样
+    :param stream: 输出流，缺省为 sys.stderr
+    :return: 后台 QueueListener
+    """
+    global _log_listener
+    _stop_log_listener()
+    output = logging.StreamHandler(stream)
+    if fmt == 'json':
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(TextLogFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(LogSampler(sample_interval))
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if isinstance(handler, logging.handlers.QueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level if isinstance(level, int) else level.upper())
+    _log_listener = logging.handlers.QueueListener(queue_handler.queue, output)
+    _log_listener.start()
+    atexit.unregister(_stop_log_listener)
+    atexit.register(_stop_log_listener)
+    return _log_listener
+
+class SlidingWindowCounter:
+    """
+    按时间分桶的滑动窗口计数器（环形数组）。
+    写入与查询均为常数时间（与请求速率无关），窗口内的计数不受条数上限影响；
+    内部多保留一个桶，保证计数只会多算、不会少算，限流不会因为分桶边界而超额。
+    """
+
+    def __init__(self, window=60, buckets=60):
+        """
+        :param window: 窗口长度（秒）
+        :param buckets: 窗口划分的桶数，决定时间精度
+        """
+        self.window = window
+        self.resolution = window / buckets  # 每个桶覆盖的时长
+        self.size = buckets + 1
+        self.buckets = [0] * self.size
+        self.head = 0  # 最新一个桶的绝对序号
+        self.total = 0
+
+    def _advance(self, current_time):
+        """
+        推进到当前时间所在的桶，清空已滑出窗口的桶
+        :param current_time: 当前时间戳
+        """
+        index = int(current_time // self.resolution)
+        if index <= self.head:
+            return
+        for i in range(max(self.head + 1, index - self.size + 1), index + 1):
+            slot = i % self.size
+            self.total -= self.buckets[slot]
+            self.buckets[slot] = 0
+        self.head = index
+
+    def add(self, amount=1, current_time=None):
+        """
+        在当前时间所在的桶中累加计数
+        :param amount: 累加值
+        :param current_time: 当前时间戳，缺省为 time.time()
+        """
+        self._advance(time.time() if current_time is None else current_time)
+        self.buckets[self.head % self.size] += amount
+        self.total += amount
+
+    def count(self, current_time=None):
+        """
+        获取窗口内的计数总和
+        :param current_time: 当前时间戳，缺省为 time.time()
+        :return: 窗口内的计数总和
+        """
+        self._advance(time.time() if current_time is None else current_time)
+        return self.total
+
+    def adjust(self, amount, at_time, current_time=None):
+        """
+        修正 at_time 时记入的计数（如按实际用量结算预留的令牌数），修正量记到原来的桶中，
+        桶滑出窗口时与原计数一起消失；该桶已滑出窗口时不做处理，桶内计数不会被减成负数
+        :param amount: 修正量，可以为负
+        :param at_time: 原计数记入的时间戳
+        :param current_time: 当前时间戳，缺省为 time.time()
+        """
+        self._advance(time.time() if current_time is None else current_time)
+        index = int(at_time // self.resolution)
+        if index <= self.head - self.size or index > self.head:
+            return
+        slot = index % self.size
+        amount = max(amount, -self.buckets[slot])
+        self.buckets[slot] += amount
+        self.total += amount
+
+    def expiry(self, amount, current_time=None):
+        """
+        计算窗口内的计数至少减少 amount 所需等待到的时间
+        :param amount: 需要滑出窗口的计数
+        :param current_time: 当前时间戳，缺省为 time.time()
+        :return: 时间戳
+        """
+        current_time = time.time() if current_time is None else current_time
+        self._advance(current_time)
+        expired = 0
+        for i in range(self.head - self.size + 1, self.head + 1):
+            expired += self.buckets[i % self.size]
+            if expired >= amount:
+                return (i + self.size) * self.resolution
+        return (self.head + self.size) * self.resolution
+
+    def snapshot(self, current_time=None):
+        """
+        导出窗口内的非零桶，用于持久化运行状态
+        :param current_time: 当前时间戳，缺省为 time.time()
+        :return: {'resolution': 桶时长, 'buckets': [[桶的绝对序号, 计数], ...]}
+        """
+        self._advance(time.time() if current_time is None else current_time)
+        buckets = [[i, self.buckets[i % self.size]] for i in range(self.head - self.size + 1, self.head + 1)
+                   if self.buckets[i % self.size]]
+        return {'resolution': self.resolution, 'buckets': buckets}
+
+    def restore(self, snapshot, offset=0, current_time=None):
+        """
+        累加 snapshot() 导出的计数，已滑出窗口的桶被忽略；桶时长不同（窗口配置已修改）时不恢复
+        :param snapshot: snapshot() 的返回值
+        :param offset: 快照中的时间需要平移的秒数
+        :param current_time: 当前时间戳，缺省为 time.time()
+        """
+        if snapshot['resolution'] != self.resolution:
+            return
+        self._advance(time.time() if current_time is None else current_time)
+        shift = round(offset / self.resolution)
+        for index, amount in snapshot['buckets']:
+            index += shift
+            if self.head - self.size < index <= self.head:
+                self.buckets[index % self.size] += amount
+                self.total += amount
+
+class LimiterBackend:
+    """
+    限流计数器后端（进程内）：每个 LoadBalancer 独立计数。
+    多进程部署时换用 SharedMemoryLimiterBackend，让所有进程共享同一组按目标划分的计数器。
+    """
+
+    def counter(self, key, window, buckets):
+        """
+        获取（或创建）一个滑动窗口计数器
+        :param key: 计数器名，如 '目标ID:rpm'
+        :param window: 窗口长度（秒）
+        :param buckets: 窗口划分的桶数
+        :return: 与 SlidingWindowCounter 接口相同的计数器
+        """
+        return SlidingWindowCounter(window, buckets)
+
+    def lock(self):
+        """
+        获取跨进程的互斥锁，保证“检查额度 + 记录派发”在所有进程间是原子的；进程内后端无需加锁
+        """
+        return contextlib.nullcontext()
+
+    def close(self):
+        pass
+
+
+class SharedWindowCounter(SlidingWindowCounter):
+    """
+    存放在共享内存中的滑动窗口计数器：算法与 SlidingWindowCounter 相同，
+    桶数组、最新桶序号与总数直接读写共享内存，每次操作在后端的文件锁内完成。
+    """
+
+    def __init__(self, backend, state, window, buckets):
+        """
+        :param backend: 所属的 SharedMemoryLimiterBackend
+        :param state: 按 int64 解释的共享内存视图，布局为 [head, total, 桶0, 桶1, ...]
+        :param window: 窗口长度（秒）
+        :param buckets: 窗口划分的桶数
+        """
+        self.backend = backend
+        self.window = window
+        self.resolution = window / buckets
+        self.size = buckets + 1
+        self.state = state
+        self.buckets = state[2:2 + self.size]
+        backend.views.append(self.buckets)
+
+    @property
+    def head(self):
+        return self.state[0]
+
+    @head.setter
+    def head(self, value):
+        self.state[0] = value
+
+    @property
+    def total(self):
+        return self.state[1]
+
+    @total.setter
+    def total(self, value):
+        self.state[1] = value
+
+    def add(self, amount=1, current_time=None):
+        with self.backend.lock():
+            super().add(amount, current_time)
+
+    def count(self, current_time=None):
+        with self.backend.lock():
+            return super().count(current_time)
+
+    def adjust(self, amount, at_time, current_time=None):
+        with self.backend.lock():
+            super().adjust(amount, at_time, current_time)
+
+    def expiry(self, amount, current_time=None):
+        with self.backend.lock():
+            return super().expiry(amount, current_time)
+
+    def snapshot(self, current_time=None):
+        return None  # 计数保存在共享内存文件中，进程重启后仍然保留，不需要另行持久化
+
+
+class SharedMemoryLimiterBackend(LimiterBackend):
+    """
+    同一主机上多个负载均衡进程共享的限流后端：计数器存放在 mmap 映射的文件中（建议放在 /dev/shm），
+    用 flock 文件锁互斥，每次计数只是一次加锁和几次内存读写，不经过网络或数据库。
+    文件由固定大小的槽位组成，每个槽位保存一个计数器：[键哈希(32字节), 桶数, head, total, 桶...]。
+    """
+
+    MAGIC = b'OALBSHM1'
+    KEY_SIZE = 32
+    MAX_BUCKETS = 64  # 每个计数器最多的桶数（含多保留的一个桶）
+
+    def __init__(self, path, max_counters=1024):
+        """
+        :param path: 共享文件路径，所有进程需使用同一路径
+        :param max_counters: 文件中可容纳的计数器数
+        """
+        if fcntl is None:
+            raise RuntimeError('SharedMemoryLimiterBackend requires fcntl (POSIX systems only)')
+        self.path = path
+        self.max_counters = max_counters
+        self.slot_size = self.KEY_SIZE + 8 * (3 + self.MAX_BUCKETS)
+        self.counters = {}
+        self.views = []
+        self._depth = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = len(self.MAGIC) + self.slot_size * max_counters
+        with self.lock():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._mmap = mmap.mmap(self._fd, size)
+            if self._mmap[:len(self.MAGIC)] != self.MAGIC:
+                self._mmap[:len(self.MAGIC)] = self.MAGIC
+
+    @contextlib.contextmanager
+    def lock(self):
+        # 可重入：外层（get_target 中的检查与派发）已持锁时，计数器操作不再重复加锁
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def counter(self, key, window, buckets):
+        if buckets + 1 > self.MAX_BUCKETS:
+            raise ValueError(f"Counter {key} needs {buckets + 1} buckets, at most {self.MAX_BUCKETS} are supported")
+        cache_key = (key, window, buckets)
+        if cache_key in self.counters:
+            return self.counters[cache_key]
+        digest = hashlib.sha256(f'{key}:{window}:{buckets}'.encode('utf-8')).digest()
+        with self.lock():
+            offset = None
+            for index in range(self.max_counters):
+                slot = len(self.MAGIC) + index * self.slot_size
+                stored = self._mmap[slot:slot + self.KEY_SIZE]
+                if stored == digest:
+                    offset = slot
+                    break
+                if stored == bytes(self.KEY_SIZE):  # 槽位按顺序分配，遇到空槽说明计数器尚不存在
+                    offset = slot
+                    self._mmap[slot:slot + self.KEY_SIZE] = digest
+                    break
+            if offset is None:
+                raise RuntimeError(f'Shared limiter file {self.path} is full ({self.max_counters} counters)')
+        view = memoryview(self._mmap)[offset + self.KEY_SIZE:offset + self.slot_size].cast('q')
+        view[0] = buckets + 1
+        state = view[1:]
+        self.views.extend([view, state])
+        counter = self.counters[cache_key] = SharedWindowCounter(self, state, window, buckets)
+        return counter
+
+    def close(self):
+        if self._fd is None:
+            return
+        for view in reversed(self.views):
+            view.release()
+        self.views.clear()
+        self.counters.clear()
+        self._mmap.close()
+        os.close(self._fd)
+        self._fd = None
+
+
+class LatencyTracker:
+    """
+    单个目标的延迟统计：首字节时间（TTFB）与总耗时的指数加权移动平均（EWMA），
+    并保留最近若干个样本用于估算分位数。读取估计值为常数时间。
+    """
+
+    def __init__(self, alpha=0.2, samples=64):
+        """
+        :param alpha: EWMA 平滑系数，越大越偏向最新样本
+        :param samples: 用于分位数估算的最近样本数
+        """
+        self.alpha = alpha
+        self.ttfb = None  # 首字节时间的 EWMA（秒）
+        self.total = None  # 完整请求耗时的 EWMA（秒）
+        self.ttfb_samples = deque(maxlen=samples)
+        self.total_samples = deque(maxlen=samples)
+
+    def _smooth(self, current, value):
+        if current is None or current == float('inf') or value == float('inf'):
+            return value
+        return current + self.alpha * (value - current)
+
+    def observe(self, ttfb, total=None):
+        """
+        记录一次测量结果
+        :param ttfb: 首字节时间（秒）；探测失败时传入 float('inf')
+        :param total: 完整请求耗时（秒），仅真实请求提供
+        """
+        self.ttfb = self._smooth(self.ttfb, ttfb)
+        if ttfb != float('inf'):
+            self.ttfb_samples.append(ttfb)
+        if total is not None:
+            self.total = self._smooth(self.total, total)
+            self.total_samples.append(total)
+
+    def observe_probe(self, latency):
+        """
+        记录一次后台探测结果，只更新 EWMA，不进入分位数样本（探测耗时远小于真实请求）
+        :param latency: 探测耗时（秒），失败时为 float('inf')
+        """
+        self.ttfb = self._smooth(self.ttfb, latency)
+
+    def estimate(self):
+        """
+        获取当前的延迟估计值，尚无样本时返回0，使新目标也有机会被选中
+        :return: 首字节时间的 EWMA（秒）
+        """
+        return 0 if self.ttfb is None else self.ttfb
+
+    def percentile(self, q, kind='ttfb'):
+        """
+        按最近样本估算延迟分位数
+        :param q: 分位数，取值 0~1
+        :param kind: 'ttfb' 或 'total'
+        :return: 延迟（秒），没有样本时返回 None
+        """
+        samples = self.ttfb_samples if kind == 'ttfb' else self.total_samples
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self):
+        return {'ttfb': self.ttfb, 'total': self.total,
+                'ttfb_samples': list(self.ttfb_samples), 'total_samples': list(self.total_samples)}
+
+    def restore(self, snapshot):
+        self.ttfb = snapshot['ttfb']
+        self.total = snapshot['total']
+        self.ttfb_samples.extend(snapshot['ttfb_samples'])
+        self.total_samples.extend(snapshot['total_samples'])
+
+class WeightIndex:
+    """
+    加权随机选择的累积权重索引（树状数组）：修改单个权重与按权重抽样均为 O(log n)。
+    权重按 SCALE 放大为整数保存，增量更新不会累积浮点误差，抽样总能落在权重大于0的目标上。
+    """
+
+    SCALE = 10 ** 6
+
+    def __init__(self, size):
+        """
+        :param size: 目标数
+        """
+        self.size = size
+        self.weights = [0] * size  # 每个位置当前的整数权重
+        self.tree = [0] * (size + 1)
+        self.total = 0
+        self.top = 1 << (size.bit_length() - 1) if size else 0  # 抽样时二分下降的起始步长
+
+    def update(self, index, weight):
+        """
+        修改单个位置的权重
+        :param index: 目标位置
+        :param weight: 新权重，小于等于0表示不参与选择
+        """
+        value = max(0, round(weight * self.SCALE))
+        delta = value - self.weights[index]
+        if not delta:
+            return
+        self.weights[index] = value
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def rebuild(self, weights):
+        """
+        按完整的权重列表在 O(n) 内重建索引
+        :param weights: 与目标位置一一对应的权重列表
+        """
+        self.weights = [max(0, round(weight * self.SCALE)) for weight in weights]
+        self.tree = [0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+
+    def sample(self):
+        """
+        按权重随机抽取一个位置
+        :return: 位置序号，所有权重均为0时返回 None
+        """
+        if self.total <= 0:
+            return None
+        r = random.randrange(self.total)
+        position, step = 0, self.top
+        while step:
+            following = position + step
+            if following <= self.size and self.tree[following] <= r:
+                position = following
+                r -= self.tree[following]
+            step >>= 1
+        return position
+
+class TargetGroup:
+    """
+    路由表中的一个模型分组：提供同一模型的目标及其独立的选择状态（就绪子集、轮询索引、累积权重索引、
+    一致性哈希环与等待队列），选择只在分组内进行，开销与分组大小而不是目标池总数相关。
+    """
+
+    RING_REPLICAS = 64  # 权重为1的目标在一致性哈希环上的虚拟节点数
+
+    def __init__(self, model, targets, weighted=False, ring=False):
+        """
+        :param model: 分组对应的模型名，None 表示不限模型的整个目标池
+        :param targets: 分组内的目标列表
+        :param weighted: 是否维护加权随机算法的累积权重索引
+        :param ring: 是否构建前缀亲和算法的一致性哈希环
+        """
+        self.model = model
+        self.targets = targets
+        self.index = {target['id']: index for index, target in enumerate(targets)}  # 目标在分组中的位置
+        self.ready = {}  # 分组内当前可立即调度的目标
+        self.current_index = 0  # 轮询算法的索引
+        self.weight_index = WeightIndex(len(targets)) if weighted else None
+        self.weights_refreshed_at = 0
+        self.waiters = []  # 等待该分组可用目标的请求最小堆，元素为 (排序键, 序号, future, 亲和键, 令牌需求)
+        self.queue_depth = 0
+        self.tokens_available_at = None  # 上一次选择因 TPM 窗口容纳不下预留而落空时，最早能容纳的时间
+        self.ring_points = []  # 一致性哈希环上各虚拟节点的位置（升序）
+        self.ring_targets = []  # 与 ring_points 对应的目标ID
+        if ring:
+            self._build_ring()
+
+    def _build_ring(self):
+        """
+        按权重为每个目标生成虚拟节点；节点位置只取决于目标ID，目标增减时其余目标的节点不变
+        """
+        nodes = []
+        for target in self.targets:
+            replicas = max(1, round(self.RING_REPLICAS * target.get('weight', 1)))
+            for replica in range(replicas):
+                digest = hashlib.blake2b(f"{target['id']}#{replica}".encode('utf-8'), digest_size=8).digest()
+                nodes.append((int.from_bytes(digest, 'big'), target['id']))
+        nodes.sort()
+        self.ring_points = [point for point, _ in nodes]
+        self.ring_targets = [target_id for _, target_id in nodes]
+
+class Histogram:
+    """
+    固定分桶的直方图，记录一次观测只需一次二分查找
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets  # 各桶的上界（升序）
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶为 +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    负载均衡器的内置指标：计数器、直方图与按需采集的仪表。
+    热路径上的记录只是字典查找与加法；仪表在导出时通过回调计算，不占用请求路径。
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    DESCRIPTIONS = {
+        'lb_requests_total': ('counter', '按目标与结果统计的上游请求数'),
+        'lb_availability_rejections_total': ('counter', '目标因流控或冷却变为不可用的次数，按原因统计'),
+        'lb_request_duration_seconds': ('histogram', '上游请求的完整耗时'),
+        'lb_time_to_first_token_seconds': ('histogram', '上游请求的首字节（首个令牌）时间'),
+        'lb_queue_wait_seconds': ('histogram', '请求等待可用目标的时间'),
+        'lb_selection_seconds': ('histogram', 'get_target 选择目标的耗时'),
+        'lb_in_flight_requests': ('gauge', '各目标正在进行的请求数'),
+        'lb_concurrency_limit': ('gauge', '各目标当前生效的自适应并发上限'),
+        'lb_tokens_per_minute': ('gauge', '各目标最近一分钟的令牌数'),
+        'lb_queue_depth': ('gauge', '等待可用目标的请求数'),
+        'lb_cache_requests_total': ('counter', '响应缓存的查询次数，按命中结果统计'),
+        'lb_affinity_spills_total': ('counter', '前缀亲和路由未能使用首选目标、溢出到环上后续目标的次数'),
+    }
+
+    def __init__(self):
+        self.counters = {}  # {(名称, 标签): 值}
+        self.histograms = {}  # {(名称, 标签): Histogram}
+        self.gauges = {}  # {名称: 返回 {标签: 值} 的回调}
+
+    def inc(self, name, labels=(), amount=1):
+        """
+        累加计数器
+        :param name: 指标名称
+        :param labels: 标签元组，如 (('target', '1'),)
+        :param amount: 累加值
+        """
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        """
+        记录一次直方图观测
+        :param name: 指标名称
+        :param value: 观测值（秒）
+        :param labels: 标签元组
+        """
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(self.LATENCY_BUCKETS)
+        histogram.observe(value)
+
+    def register_gauge(self, name, callback):
+        """
+        注册仪表，导出时调用 callback 获取 {标签: 值}
+        """
+        self.gauges[name] = callback
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def snapshot(self):
+        """
+        获取当前所有指标的快照
+        :return: {指标名称: {标签字符串: 值}}，直方图的值为 count/sum/buckets 字典
+        """
+        result = {}
+        for (name, labels), value in self.counters.items():
+            result.setdefault(name, {})[self._format_labels(labels)] = value
+        for (name, labels), histogram in self.histograms.items():
+            result.setdefault(name, {})[self._format_labels(labels)] = {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'buckets': dict(zip(list(histogram.buckets) + ['+Inf'], itertools.accumulate(histogram.counts)))
+            }
+        for name, callback in self.gauges.items():
+            result[name] = {self._format_labels(labels): value for labels, value in callback().items()}
+        return result
+
+    def render_prometheus(self):
+        """
+        按 Prometheus 文本格式导出所有指标
+        :return: 文本
+        """
+        series = {}
+        for (name, labels), value in self.counters.items():
+            series.setdefault(name, []).append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), histogram in self.histograms.items():
+            lines = series.setdefault(name, [])
+            bounds = [str(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, cumulative in zip(bounds, itertools.accumulate(histogram.counts)):
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f'{name}_sum{self._format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {histogram.count}')
+        for name, callback in self.gauges.items():
+            series[name] = [f'{name}{self._format_labels(labels)} {value}' for labels, value in callback().items()]
+
+        output = []
+        for name, lines in series.items():
+            metric_type, description = self.DESCRIPTIONS.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+def parse_duration(value):
+    """
+    解析限流响应头中的时长，支持纯数字秒数以及 '1s'、'6m0s'、'20ms'、'1h2m3.5s' 等格式
+    :param value: 响应头的值
+    :return: 秒数，无法解析时返回 None
+    """
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers, current_time):
+    """
+    解析 Retry-After（秒数或 HTTP 日期）与 retry-after-ms 响应头
+    :param headers: 响应头
+    :param current_time: 当前时间戳
+    :return: 需要等待的秒数，没有该响应头时返回 None
+    """
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - current_time)
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamRateLimit:
+    """
+    从上游 x-ratelimit-* 响应头学习到的实时限流状态。
+    两次响应之间按本地派发的请求数与令牌数扣减剩余额度，剩余额度耗尽时等到上游的重置时间。
+    """
+
+    __slots__ = ('remaining_requests', 'requests_reset_at', 'remaining_tokens', 'tokens_reset_at')
+
+    def __init__(self):
+        self.remaining_requests = None  # None 表示未知
+        self.requests_reset_at = 0
+        self.remaining_tokens = None
+        self.tokens_reset_at = 0
+
+    def update(self, headers, current_time):
+        """
+        按响应头更新剩余额度与重置时间
+        :param headers: 响应头
+        :param current_time: 当前时间戳
+        """
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is None:
+                continue
+            try:
+                remaining = int(float(remaining))
+            except ValueError:
+                continue
+            reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}', ''))
+            if reset is None:
+                reset = 60  # 没有或无法解析重置时间时按一分钟估计；0 表示额度已经重置
+            setattr(self, f'remaining_{kind}', remaining)
+            setattr(self, f'{kind}_reset_at', current_time + reset)
+
+    def consume(self, requests=0, tokens=0):
+        """
+        按本地派发扣减剩余额度
+        :param requests: 请求数
+        :param tokens: 令牌数
+        """
+        if self.remaining_requests is not None:
+            self.remaining_requests -= requests
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= tokens
+
+    def available_at(self, current_time):
+        """
+        获取上游额度允许下一次请求的时间
+        :param current_time: 当前时间戳
+        :return: (时间戳, 限制原因)，原因为 RPM/TPM，额度充足时为 (current_time, None)
+        """
+        if self.remaining_requests is not None and current_time >= self.requests_reset_at:
+            self.remaining_requests = None  # 已过重置时间，额度恢复为未知
+        if self.remaining_tokens is not None and current_time >= self.tokens_reset_at:
+            self.remaining_tokens = None
+        if self.remaining_requests is not None and self.remaining_requests <= 0:
+            return self.requests_reset_at, 'RPM'
+        if self.remaining_tokens is not None and self.remaining_tokens <= 0:
+            return self.tokens_reset_at, 'TPM'
+        return current_time, None
+
+    def snapshot(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def restore(self, snapshot, offset=0):
+        """
+        :param offset: 快照中的重置时间需要平移的秒数
+        """
+        self.remaining_requests = snapshot['remaining_requests']
+        self.requests_reset_at = snapshot['requests_reset_at'] + offset
+        self.remaining_tokens = snapshot['remaining_tokens']
+        self.tokens_reset_at = snapshot['tokens_reset_at'] + offset
+
+class AdaptiveConcurrencyLimit:
+    """
+    单个目标的自适应并发上限（AIMD + 延迟梯度）：
+    上限被充分使用时加性增长（每个往返约 +1），遇到 429/5xx/连接错误时按 backoff_ratio 乘性下降。
+    流式请求的首字节时间（TTFT）明显高于最近样本的低分位基线时视为排队，小幅乘性下降；
+    非流式请求的耗时主要取决于生成长度，不参与延迟梯度判断。
+    """
+
+    __slots__ = ('limit', 'min_limit', 'max_limit', 'backoff_ratio', 'tolerance', 'samples')
+
+    WINDOW = 100  # 参与基线计算的最近 TTFT 样本数
+    MIN_SAMPLES = 20  # 样本不足时不做延迟梯度判断
+    BASELINE_PERCENTILE = 0.1  # 基线取最近样本的低分位
+
+    def __init__(self, initial, min_limit, max_limit, backoff_ratio=0.5, tolerance=2.0):
+        """
+        :param initial: 初始并发上限
+        :param min_limit: 并发上限的下限
+        :param max_limit: 并发上限的上限
+        :param backoff_ratio: 遇到错误时的下降比例
+        :param tolerance: TTFT 超过基线的倍数时视为排队，开始下降
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.tolerance = tolerance
+        self.samples = deque(maxlen=self.WINDOW)  # 最近的流式 TTFT 样本
+
+    @property
+    def current(self):
+        """
+        当前生效的并发上限
+        """
+        return max(self.min_limit, int(self.limit))
+
+    @property
+    def baseline(self):
+        """
+        无负载延迟基线：最近 TTFT 样本的低分位，样本不足时为 None
+        """
+        if len(self.samples) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(self.BASELINE_PERCENTILE * (len(ordered) - 1))]
+
+    def on_success(self, ttft, in_flight):
+        """
+        记录一次成功请求并调整上限
+        :param ttft: 流式请求的首字节时间（秒）；非流式请求传入 None，只做加性增长判断
+        :param in_flight: 该目标当前的在途请求数
+        """
+        if ttft is not None:
+            baseline = self.baseline
+            self.samples.append(ttft)
+            if baseline is not None and ttft > baseline * self.tolerance:
+                self.limit = max(self.min_limit, self.limit * 0.9)
+                return
+        if in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_drop(self):
+        """
+        记录一次过载信号（429/5xx/连接错误）
+        """
+        self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+
+    def reconfigure(self, min_limit, max_limit):
+        """
+        更新上下限并把当前上限收敛到新范围内，保留已学习到的延迟样本
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max_limit, max(min_limit, self.limit))
+
+    def snapshot(self):
+        return {'limit': self.limit, 'samples': list(self.samples)}
+
+    def restore(self, snapshot):
+        """
+        恢复已学习到的上限与延迟样本，上限收敛到当前配置的范围内
+        """
+        self.limit = min(self.max_limit, max(self.min_limit, snapshot['limit']))
+        self.samples.clear()
+        self.samples.extend(snapshot.get('samples', ()))
+
+class CircuitBreaker:
+    """
+    单个目标的熔断器：closed（正常）→ open（熔断）→ half_open（半开试探）。
+    带冷却时间的错误码（429/5xx/403）或最近请求失败率超过阈值时熔断，
+    连续熔断的时长按指数退避增长；熔断到期后只放行有限个试探请求，试探成功才恢复。
+    """
+
+    __slots__ = ('target', 'state', 'open_until', 'trips', 'trials', 'outcomes', 'failures')
+
+    COOLDOWN_CODES = (429, 500, 502, 503, 403)  # 带固定冷却时间的错误码
+
+    def __init__(self, target):
+        self.target = target
+        self.state = 'closed'
+        self.open_until = 0  # 熔断结束时间
+        self.trips = 0  # 连续熔断次数，决定退避倍数
+        self.trials = 0  # 半开状态下正在进行的试探请求数
+        self.outcomes = deque(maxlen=target['failure_window'])  # 最近请求结果，True 表示失败
+        self.failures = 0  # outcomes 中的失败数
+
+    def _record(self, failed):
+        if len(self.outcomes) == self.outcomes.maxlen:
+            self.failures -= self.outcomes[0]
+        self.outcomes.append(failed)
+        self.failures += failed
+
+    def _trip(self, base_time, current_time):
+        duration = min(base_time * self.target['backoff_multiplier'] ** self.trips, self.target['max_backoff_time'])
+        self.state = 'open'
+        self.open_until = max(self.open_until, current_time + duration)
+        self.trips += 1
+        self.trials = 0
+
+    def available_at(self, current_time):
+        """
+        获取熔断器允许下一次请求的时间
+        :param current_time: 当前时间戳
+        :return: 时间戳；半开试探名额已用完时返回 float('inf')，等待试探结果
+        """
+        if self.state == 'open':
+            if current_time < self.open_until:
+                return self.open_until
+            self.state = 'half_open'
+        if self.state == 'half_open' and self.trials >= self.target['half_open_max_calls']:
+            return float('inf')
+        return current_time
+
+    def on_dispatch(self, current_time):
+        """
+        记录一次请求被派发，半开状态下占用一个试探名额
+        :param current_time: 当前时间戳
+        """
+        if self.available_at(current_time) <= current_time and self.state == 'half_open':
+            self.trials += 1
+
+    def record_success(self):
+        """
+        记录请求成功，半开试探成功时恢复正常并重置退避
+        """
+        if self.state == 'half_open':
+            self.state = 'closed'
+            self.trips = 0
+            self.trials = 0
+            self.outcomes.clear()
+            self.failures = 0
+        self._record(False)
+
+    def record_failure(self, status_code, current_time, retry_after=None):
+        """
+        记录请求失败，按错误码冷却时间或失败率决定是否熔断
+        :param status_code: HTTP 状态码，连接错误为 0
+        :param current_time: 当前时间戳
+        :param retry_after: 上游通过 Retry-After 给出的等待时间（秒），优先于配置的冷却时间
+        """
+        if status_code not in self.COOLDOWN_CODES and status_code != 0:
+            self.release()  # 请求本身的错误（如 400）与目标健康无关
+            return
+
+        self._record(True)
+        if retry_after is not None and status_code in self.COOLDOWN_CODES:
+            # 上游明确告知了等待时间，不再叠加指数退避
+            self.state = 'open'
+            self.open_until = current_time + retry_after
+            self.trials = 0
+        elif status_code in self.COOLDOWN_CODES and self.target.get(f'{status_code}_wait_time'):
+            self._trip(self.target[f'{status_code}_wait_time'], current_time)
+        elif self.state == 'half_open' or (len(self.outcomes) >= self.target['min_requests'] and
+                                           self.failures >= self.target['failure_rate_threshold'] * len(self.outcomes)):
+            self._trip(self.target['circuit_open_time'], current_time)
+
+    def release(self):
+        """
+        归还半开试探名额（请求结果与目标健康无关时）
+        """
+        if self.state == 'half_open' and self.trials:
+            self.trials -= 1
+
+    def snapshot(self):
+        return {'state': self.state, 'open_until': self.open_until, 'trips': self.trips,
+                'outcomes': [int(failed) for failed in self.outcomes]}
+
+    def restore(self, snapshot, offset=0):
+        """
+        恢复熔断状态与最近请求结果；保存时进行中的试探请求已随进程结束，试探名额清零
+        :param offset: 快照中的熔断结束时间需要平移的秒数
+        """
+        self.state = snapshot['state']
+        self.open_until = snapshot['open_until'] + offset if snapshot['open_until'] else 0
+        self.trips = snapshot['trips']
+        self.trials = 0
+        self.outcomes.extend(bool(failed) for failed in snapshot['outcomes'])
+        self.failures = sum(self.outcomes)
+
+def canonical_request_key(request_data):
+    """
+    计算请求的规范化哈希：对模型、消息与采样参数做排序后的 JSON 序列化再取 SHA-256，
+    与传输相关的字段（stream、stream_options、user）不参与计算
+    :param request_data: 请求的数据
+    :return: 十六进制哈希字符串
+    """
+    canonical = {key: value for key, value in request_data.items() if key not in ('stream', 'stream_options', 'user')}
+    payload = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def prefix_affinity_key(request_data, max_chars=2048):
+    """
+    计算请求的前缀亲和键：取消息列表开头的系统消息与第一条用户消息，按角色与文本规范化（合并空白）后
+    截取前 max_chars 个字符，连同模型名取哈希。同一系统提示、同一会话的后续轮次得到相同的键
+    :param request_data: 请求的数据
+    :param max_chars: 参与计算的前缀最大字符数
+    :return: 64 位整数哈希，没有消息时返回 None
+    """
+    parts = []
+    for message in request_data.get('messages') or ():
+        content = message.get('content')
+        if isinstance(content, list):  # 多模态消息只取文本部分，其他部分以类型占位
+            content = ' '.join(part.get('text', '') if part.get('type') == 'text' else f"<{part.get('type')}>"
+                               for part in content if isinstance(part, dict))
+        parts.append(f"{message.get('role')}:{' '.join(str(content or '').split())}")
+        if message.get('role') not in ('system', 'developer'):
+            break
+    if not parts:
+        return None
+    prefix = '\n'.join(parts)[:max_chars]
+    digest = hashlib.blake2b(f"{request_data.get('model')}\n{prefix}".encode('utf-8', 'surrogatepass'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class ResponseCache:
+    """
+    确定性请求的响应缓存：内存 LRU 一级缓存 + 可选的 SQLite 磁盘二级缓存，支持 TTL 与容量淘汰。
+    SQLite 读写在单独的线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, path=None, max_disk_entries=100000):
+        """
+        :param max_entries: 内存缓存的最大条目数
+        :param ttl: 缓存有效期（秒）
+        :param path: SQLite 文件路径，为 None 时只使用内存缓存
+        :param max_disk_entries: 磁盘缓存的最大条目数
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()  # {键: (过期时间, 响应)}
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.skipped = 0
+        self._disk_writes = 0
+        self._db = None
+        self._executor = None
+        if path:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='response-cache')
+            self._executor.submit(self._open_db).result()
+
+    def _open_db(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, response TEXT, created_at REAL, expires_at REAL)')
+        self._db.commit()
+
+    @staticmethod
+    def is_deterministic(request_data):
+        """
+        判断请求是否确定性（temperature 为0且只生成一个结果），相同的确定性请求可以共用同一个结果
+        :param request_data: 请求的数据
+        :return: 是否确定性
+        """
+        return request_data.get('temperature') == 0 and request_data.get('n', 1) == 1
+
+    @staticmethod
+    def is_cacheable(request_data):
+        """
+        判断请求是否可以缓存：只缓存非流式的确定性请求
+        :param request_data: 请求的数据
+        :return: 是否可以缓存
+        """
+        return ResponseCache.is_deterministic(request_data) and not request_data.get('stream')
+
+    def _disk_get(self, key, current_time):
+        row = self._db.execute('SELECT response, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < current_time:
+            return None
+        return row[1], json.loads(row[0])
+
+    def _disk_set(self, key, response, current_time, expires_at):
+        self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(response, ensure_ascii=False), current_time, expires_at))
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            # 定期清理过期条目，并按写入时间淘汰超出容量的旧条目
+            self._db.execute('DELETE FROM cache WHERE expires_at < ?', (current_time,))
+            self._db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created_at '
+                             'LIMIT MAX(0, (SELECT COUNT(*) FROM cache) - ?))', (self.max_disk_entries,))
+        self._db.commit()
+
+    def _remember(self, key, expires_at, response):
+        self.memory[key] = (expires_at, response)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    async def get(self, key):
+        """
+        查询缓存，先查内存再查磁盘；磁盘命中的条目会提升到内存
+        :param key: canonical_request_key 计算的键
+        :return: 缓存的响应，未命中时返回 None
+        """
+        current_time = time.time()
+        entry = self.memory.get(key)
+        if entry is not None:
+            if entry[0] >= current_time:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.memory[key]
+
+        if self._db is not None:
+            entry = await asyncio.get_running_loop().run_in_executor(self._executor, self._disk_get, key, current_time)
+            if entry is not None:
+                self._remember(key, *entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[1]
+
+        self.misses += 1
+        return None
+
+    async def set(self, key, response):
+        """
+        写入缓存
+        :param key: canonical_request_key 计算的键
+        :param response: 响应 JSON
+        """
+        current_time = time.time()
+        expires_at = current_time + self.ttl
+        self._remember(key, expires_at, response)
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._disk_set, key, response, current_time, expires_at)
+
+    def stats(self):
+        """
+        获取缓存命中统计
+        :return: 统计信息字典
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'skipped': self.skipped,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'memory_entries': len(self.memory)
+        }
+
+    def close(self):
+        """
+        关闭磁盘缓存
+        """
+        if self._executor is not None:
+            self._executor.submit(self._db.close).result()
+            self._executor.shutdown()
+            self._executor = None
+            self._db = None
+
+async def read_sse_event(stream):
+    """
+    从响应流中读取一个完整的 SSE 事件（以空行结束）
+    :param stream: aiohttp 的 StreamReader
+    :return: 事件原始字节（包含结尾空行），流结束时返回 None
+    """
+    lines = []
+    while True:
+        line = await stream.readline()
+        if not line:
+            return b''.join(lines) + b'\n' if lines else None
+        if line in (b'\n', b'\r\n'):
+            if lines:
+                return b''.join(lines) + b'\n'
+            continue
+        lines.append(line)
+
+
+def usage_total_tokens(response_data):
+    """
+    读取响应（或流式响应的最后一个数据块）中 usage.total_tokens
+    :return: 令牌总数，响应中没有时返回 None
+    """
+    usage = response_data.get('usage') if isinstance(response_data, dict) else None
+    total = usage.get('total_tokens') if isinstance(usage, dict) else None
+    return total if isinstance(total, int) else None
+
+
+class TokenReservation:
+    """
+    一次请求在目标 TPM 窗口中预留的令牌：发出前按提示令牌数 + max_tokens 预留，收到响应后按实际用量结算
+    """
+
+    __slots__ = ('target_id', 'tokens', 'reserved_at', 'settled')
+
+    def __init__(self, target_id, tokens, reserved_at):
+        self.target_id = target_id
+        self.tokens = tokens
+        self.reserved_at = reserved_at
+        self.settled = False
+
+class UpstreamError(Exception):
+    """
+    上游以客户端错误（CLIENT_ERROR_STATUSES）拒绝了请求，携带上游的状态码与错误内容
+    """
+
+    def __init__(self, status, body):
+        """
+        :param status: 上游响应的状态码
+        :param body: 上游的错误内容，能解析为 JSON 时为解析后的对象，否则为原始文本
+        """
+        super().__init__(f"Upstream rejected the request with status {status}: {body}")
+        self.status = status
+        self.body = body
+
+    @classmethod
+    def from_text(cls, status, text):
+        try:
+            return cls(status, json.loads(text))
+        except ValueError:
+            return cls(status, text)
+
+class StreamResponse:
+    """
+    流式响应：按到达顺序迭代上游返回的 SSE 事件（原始字节）。
+    迭代结束或调用 aclose() 时释放连接与并发名额，并完成限流记账与延迟统计；
+    上游在最后一个数据块中返回 usage 时，按实际用量结算令牌预留。
+    """
+
+    def __init__(self, balancer, target, response, first_event, start_time, ttft, reservation):
+        self.balancer = balancer
+        self.target = target
+        self.response = response
+        self.start_time = start_time
+        self.ttft = ttft  # 首个事件到达时间（秒）
+        self.reservation = reservation
+        self.usage_tokens = None  # 数据块中读到的 usage.total_tokens
+        self.closed = False
+        self._first_event = first_event
+
+    def _scan_usage(self, event):
+        # 只解析带 total_tokens 的数据块（通常是最后一块），其余事件不做 JSON 解码
+        if b'"total_tokens"' not in event:
+            return
+        for line in event.splitlines():
+            if line.startswith(b'data:'):
+                try:
+                    tokens = usage_total_tokens(json.loads(line[5:]))
+                except ValueError:
+                    continue
+                if tokens is not None:
+                    self.usage_tokens = tokens
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        failed = False
+        try:
+            if self._first_event is not None:
+                event, self._first_event = self._first_event, None
+                self._scan_usage(event)
+                yield event
+            while True:
+                event = await read_sse_event(self.response.content)
+                if event is None:
+                    break
+                self._scan_usage(event)
+                yield event
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failed = True
+            logger.error("Stream from %s was interrupted: %s", self.target['id'], e, extra={'target': self.target['id']})
+        finally:
+            await self.aclose(failed)
+
+    def _release(self):
+        if self.closed:
+            return False
+        self.closed = True
+        self.response.release()
+        self.balancer._release_slot(self.target)
+        return True
+
+    async def aclose(self, failed=False):
+        """
+        关闭流并记账；首字节之后的失败不再重试，只记录为失败。
+        没有读到 usage 或流中途中断时保留全部预留（上游已生成的部分同样计入额度）
+        :param failed: 流是否因为连接错误而中断
+        """
+        if not self._release():
+            return
+        self.balancer._settle_tokens(self.reservation, None if failed else self.usage_tokens)
+        if failed:
+            await self.balancer.report_failure(self.target, 0)
+        else:
+            self.balancer._observe_latency(self.target, self.ttft, time.monotonic() - self.start_time, stream=True)
+            await self.balancer.report_success(self.target, self.usage_tokens or self.reservation.tokens)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    def __del__(self):
+        # 调用方未关闭流时兜底释放连接与并发名额
+        if not self.closed:
+            self.balancer.breakers[self.target['id']].release()
+            self._release()
+
+class TokenCounter:
+    """
+    请求令牌数估算器：按聊天消息内容与消息格式开销计数，
+    相同内容的计数结果缓存在有界 LRU 中，超长文本放到线程池中编码以免阻塞事件循环。
+    """
+
+    TOKENS_PER_MESSAGE = 3  # 每条消息的格式开销
+    TOKENS_PER_NAME = 1  # 消息带 name 字段时的额外开销
+    TOKENS_PER_REPLY = 3  # 回复的起始开销
+
+    def __init__(self, encoder=None, cache_size=4096, offload_threshold=32768, approximate=False):
+        """
+        :param encoder: tiktoken 编码器；为 None 或 approximate=True 时使用近似估算
+        :param cache_size: LRU 缓存的最大条目数
+        :param offload_threshold: 文本长度（字符）超过该值时放到线程池中编码
+        :param approximate: 是否使用按字符数的快速近似估算（约4个字符1个令牌）
+        """
+        self.encoder = encoder
+        self.cache_size = cache_size
+        self.offload_threshold = offload_threshold
+        self.approximate = approximate or encoder is None
+        self.cache = OrderedDict()
+
+    @staticmethod
+    def _texts(request_data):
+        """
+        提取请求中需要计数的文本及消息开销
+        :return: (文本列表, 固定开销令牌数)
+        """
+        messages = request_data.get('messages')
+        if messages is None:
+            prompt = request_data.get('prompt', '')
+            return [prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False)], 0
+
+        texts, overhead = [], TokenCounter.TOKENS_PER_REPLY
+        for message in messages:
+            overhead += TokenCounter.TOKENS_PER_MESSAGE
+            for key, value in message.items():
+                if key == 'content' and isinstance(value, list):
+                    # 多模态内容只统计文本部分
+                    texts.extend(part.get('text', '') for part in value if isinstance(part, dict))
+                elif isinstance(value, str):
+                    texts.append(value)
+                    if key == 'name':
+                        overhead += TokenCounter.TOKENS_PER_NAME
+        return texts, overhead
+
+    async def _count_text(self, text):
+        if not text:
+            return 0
+        if self.approximate:
+            return (len(text) + 3) // 4
+
+        key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        count = self.cache.get(key)
+        if count is not None:
+            self.cache.move_to_end(key)
+            return count
+
+        if len(text) > self.offload_threshold:
+            tokens = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.encoder.encode, text, disallowed_special=()))
+        else:
+            tokens = self.encoder.encode(text, disallowed_special=())
+        count = len(tokens)
+
+        self.cache[key] = count
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return count
+
+    async def count(self, request_data):
+        """
+        计算请求的提示令牌数
+        :param request_data: 请求的数据
+        :return: 令牌数
+        """
+        texts, overhead = self._texts(request_data)
+        total = overhead
+        for text in texts:
+            total += await self._count_text(text)
+        return total
+
+class SingleFlight:
+    """
+    单飞调用：相同请求的并发调用共享同一次上游请求。
+    非流式调用共享同一个结果；流式调用由一个任务读取上游 SSE 流并分发给所有订阅者，
+    后加入的订阅者会从头回放已收到的事件。只有所有等待者都离开后才取消上游请求。
+    """
+
+    def __init__(self, coro, on_finish):
+        """
+        :param coro: 实际发送请求的协程
+        :param on_finish: 调用结束（结果已确定或流已结束）时的回调，参数为本对象
+        """
+        self.refs = 0  # 仍需要结果的等待者与订阅者数
+        self.events = []  # 流式调用已收到的事件
+        self.finished = False
+        self._changed = asyncio.Event()
+        self._on_finish = on_finish
+        self._pump_task = None
+        self.task = asyncio.create_task(coro)
+        self.task.add_done_callback(self._on_result)
+
+    def _on_result(self, task):
+        if task.cancelled() or task.exception() is not None or not isinstance(task.result(), StreamResponse):
+            self._finish()
+        else:
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump(task.result()))
+
+    async def _pump(self, upstream):
+        try:
+            async for event in upstream:
+                self.events.append(event)
+                self._notify()
+        finally:
+            self._finish()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            self._notify()
+            self._on_finish(self)
+
+    def release(self):
+        """
+        等待者或订阅者离开；最后一个离开时取消上游请求或停止读取上游流
+        """
+        self.refs -= 1
+        if self.refs == 0:
+            if not self.task.done():
+                self.task.cancel()
+            elif self._pump_task is not None and not self._pump_task.done():
+                self._pump_task.cancel()
+
+    async def join(self, copy_result=False):
+        """
+        加入调用并等待结果，取消等待不会影响其他等待者
+        :param copy_result: 是否返回结果的深拷贝，避免多个调用方共享同一个可变对象
+        :return: 非流式时为响应 JSON；流式时为 FlightSubscriber；失败返回 None
+        """
+        self.refs += 1
+        try:
+            result = await asyncio.shield(self.task)
+        except BaseException:
+            self.release()
+            raise
+        if isinstance(result, StreamResponse):
+            return FlightSubscriber(self)  # 订阅者接管本次引用，在关闭时释放
+        self.release()
+        return copy.deepcopy(result) if copy_result else result
+
+
+class FlightSubscriber:
+    """
+    单飞流式调用的订阅者，用法与 StreamResponse 相同
+    """
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        index = 0
+        try:
+            while True:
+                if index < len(self.flight.events):
+                    index += 1
+                    yield self.flight.events[index - 1]
+                elif self.flight.finished:
+                    break
+                else:
+                    await self.flight._changed.wait()
+        finally:
+            self._close()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.flight.release()
+
+    async def aclose(self):
+        self._close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._close()
+
+    def __del__(self):
+        self._close()
 
 class LoadBalancer:
-    def __init__(self, targets, algorithm='weighted_random', concurrency_limit=10):
+    WEIGHT_FLOOR = 0.05  # 有效权重中健康度与剩余额度系数的下限
+    WEIGHT_REFRESH_INTERVAL = 1  # 全量重建有效权重的间隔（秒）
+    RANDOM_PICK_ATTEMPTS = 4  # 随机算法在分组位置上拒绝抽样的次数，均未抽中就绪目标时改为扫描候选
+
+    def __init__(self, targets, algorithm='weighted_random', concurrency_limit=None, approximate_tokens=False,
+                 max_wait_time=300, max_queue_depth=0, queue_order='fifo',
+                 hedge=False, hedge_percentile=0.95, hedge_budget=0.05, metrics_port=None,
+                 response_cache=None, single_flight=False, limiter_backend=None, log_payloads=False,
+                 config_path=None, config_reload_interval=5, model_aliases=None,
+                 affinity_prefix_chars=2048, affinity_load_factor=1.25, state_path=None, state_save_interval=30):
+        """
+        初始化负载均衡器
+        :param targets: 目标服务器列表，每个目标是一个包含各种配置的字典
+        :param algorithm: 负载均衡算法，可选 'round_robin'（轮询）, 'random'（随机）, 
+                          'weighted_random'（加权随机）, 'least_used'（最少使用）, 
+                          'dynamic_least_load'（动态最低负载）, 'lowest_latency'（最低延迟）,
+                          'prefix_affinity'（前缀亲和：相同提示前缀固定到同一目标，以利用上游的提示缓存）
+        :param concurrency_limit: 所有目标合计的并发请求数上限，默认为 None（不限制），
+                                  由各目标的自适应并发上限决定每个目标能占用多少并发
+        :param approximate_tokens: 是否使用按字符数的近似令牌估算代替 tiktoken 编码
+        :param max_wait_time: 请求等待可用目标的默认最长时间（秒）
+        :param max_queue_depth: 等待队列的最大长度，0 表示不限制
+        :param queue_order: 等待队列的唤醒顺序，'fifo'（先到先得）或 'deadline'（截止时间最早优先）
+        :param hedge: 是否启用对冲请求：超过首字节延迟分位数仍无响应时向另一个目标发送副本
+        :param hedge_percentile: 触发对冲的首字节延迟分位数
+        :param hedge_budget: 对冲请求占正常请求的最大比例
+        :param metrics_port: 在本机该端口以 Prometheus 文本格式导出指标（/metrics），为 None 时不启动
+        :param response_cache: 确定性请求的响应缓存，可以是 ResponseCache 实例或其参数字典，为 None 时不缓存
+        :param single_flight: 是否合并完全相同的并发确定性请求（temperature 为0且 n 为1），共享同一次上游调用
+                              （流式请求共享同一个上游流）；采样请求各自发送，保证得到独立的结果
+        :param limiter_backend: RPS/RPM/TPM 计数器的存放后端，可以是 LimiterBackend 实例或
+                                SharedMemoryLimiterBackend 的参数字典（多进程共享额度），为 None 时进程内计数
+        :param log_payloads: 是否在 DEBUG 日志中记录完整的请求与响应内容，默认不记录
+        :param config_path: JSON 配置文件路径；设置后 start() 会监视该文件，修改后热更新目标池
+        :param config_reload_interval: 检查配置文件是否修改的间隔（秒）
+        :param model_aliases: 模型别名表 {别名: 模型名}，请求中的别名按对应模型路由
+        :param affinity_prefix_chars: 前缀亲和算法计算亲和键时使用的前缀最大字符数
+        :param affinity_load_factor: 前缀亲和算法的负载上限系数：目标的在途请求数超过分组平均值的该倍数时溢出到环上的下一个目标
+        :param state_path: 运行状态快照文件路径；设置后 start() 时恢复各目标的限流窗口、冷却、熔断与延迟状态，
+                           运行期间定期保存、aclose() 时再保存一次，为 None 时不持久化
+        :param state_save_interval: 定期保存运行状态快照的间隔（秒）
+        """
+        # 缺省值设置：为每个目标设置默认的流控和重试配置
+        default_config = {
+            'id': None,  # 目标的唯一标识符
+            'sk': 'sk-test',  # 默认的API密钥
+            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',  # 默认的User-Agent
+            'weight': 1,  # 默认的权重
+            'api_url': None,  # 默认的API URL（如果设置，将优先于api_domain）
+            'api_domain': 'https://api.oneapi.com',  # 默认的API域名
+            'model': 'gpt-4o-mini',  # 默认的模型名称，用于请求体中
+            'models': None,  # 该目标提供的模型名列表，缺省为 [model]
+            'model_map': None,  # 对外模型名到上游模型名的映射，未列出的模型按原名发送
+            'rps_limit': 2,  # 每秒请求数限制
+            'rpm_limit': 120,  # 每分钟请求数限制
+            'tpm_limit': 1000000,  # 每分钟内容令牌数限制
+            'completion_tokens_reserve': 256,  # 请求未给出 max_tokens 时为补全预留的令牌数
+            'mrr': 0.3,  # 最短请求间隔
+            'sri': 0.5,  # 成功到请求的间隔
+            '429_wait_time': 60,  # 触发429错误后的等待时间
+            '500_wait_time': 5,  # 触发500错误后的等待时间
+            '502_wait_time': 5,  # 触发502错误后的等待时间
+            '503_wait_time': 5,  # 触发503错误后的等待时间
+            '403_wait_time': 15,  # 触发403错误后的等待时间
+            'failure_window': 20,  # 统计失败率的最近请求数
+            'min_requests': 5,  # 按失败率熔断前至少需要的请求数
+            'failure_rate_threshold': 0.5,  # 触发熔断的失败率
+            'circuit_open_time': 5,  # 失败率触发熔断的基础时长（秒）
+            'backoff_multiplier': 2,  # 连续熔断时熔断时长的增长倍数
+            'max_backoff_time': 600,  # 熔断时长上限（秒）
+            'half_open_max_calls': 1,  # 半开状态下允许同时进行的试探请求数
+            'initial_concurrency': 8,  # 自适应并发上限的初始值
+            'min_concurrency': 1,  # 自适应并发上限的下限
+            'max_concurrency': 64,  # 自适应并发上限的上限
+            'retry_wait_time': 3,  # 单请求任务重试等待时间
+            'max_retries': 2,  # 单请求任务重试次数
+            'connection_limit': 100,  # 每个目标连接池的最大连接数
+            'dns_cache_ttl': 300,  # DNS解析结果缓存时间（秒）
+            'keepalive_timeout': 30,  # 空闲长连接的保持时间（秒）
+            'prewarm_connections': 0,  # 启动时为该目标预热的连接数
+            'latency_probe_interval': 30  # 后台延迟探测间隔（秒），0 表示只使用真实请求的被动测量
+        }
+
+        # 将缺省值应用到每个目标配置中
+        self.default_config = default_config
+        self.targets = [{**default_config, **target} for target in targets]
+        self.algorithm = algorithm
+        self.affinity_prefix_chars = affinity_prefix_chars
+        self.affinity_load_factor = affinity_load_factor
+        self.log_payloads = log_payloads
+        if isinstance(limiter_backend, dict):
+            limiter_backend = SharedMemoryLimiterBackend(**limiter_backend)
+        self.limiter_backend = limiter_backend or LimiterBackend()
+        # 以下按目标ID索引的状态由 _add_target_state 为每个目标创建，热更新目标池时保留
+        self.last_used = {}  # 记录每个目标最后一次使用时间
+        self.last_request = {}  # 记录每个目标最后一次发出请求的时间
+        self.rps_counts = {}  # 每秒请求数滑动窗口
+        self.request_counts = {}  # 每分钟请求数滑动窗口
+        self.token_counts = {}  # 每分钟令牌数滑动窗口
+        self.load_counts = {}  # 动态最低负载算法使用的请求数窗口
+        self.concurrency_limit = concurrency_limit  # 合计并发请求数上限
+        # 设置了合计上限时使用异步信号量限制并发数，否则只受各目标的自适应并发上限约束
+        self.semaphore = asyncio.Semaphore(concurrency_limit) if concurrency_limit else None
+        self.sessions = {}  # 每个目标独立的长连接会话（连接池），惰性创建
+        self.target_map = {}  # 按ID索引目标（不含正在排空的已移除目标）
+        self.ready = {}  # 当前可立即调度的目标
+        self.cooling = []  # 冷却中的目标最小堆，元素为 (可调度时间, 序号, 目标ID)
+        self.next_eligible = {}  # 每个目标当前的可调度时间
+        self._schedule_seq = itertools.count()  # 堆元素的插入序号，保证比较稳定
+        self.latency = {}  # 每个目标的延迟统计
+        self.breakers = {}  # 每个目标的熔断器
+        self.upstream_limits = {}  # 从响应头学习到的上游额度
+        self.draining = {}  # 已从目标池移除、等待在途请求结束的目标 {目标ID: 目标}
+        self._closing = []  # 正在关闭的已移除目标连接池
+        self._tasks = []  # 后台任务
+        self.max_wait_time = max_wait_time
+        self.max_queue_depth = max_queue_depth
+        self.queue_order = queue_order
+        self.queue_depth = 0  # 所有分组中仍在等待的请求数
+        self._waiter_seq = itertools.count()
+        self._wakeup_handle = None  # 下一个目标重新可用时触发的定时器
+        self._wakeup_at = None
+        self._dispatch_task = None
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self._hedge_tokens = 0  # 对冲预算：每个请求积累 hedge_budget，每次对冲消耗1
+        self.hedges_sent = 0
+        self.in_flight = {}  # 每个目标已派发且尚未结束的请求数
+        self.concurrency_limits = {}  # 每个目标的自适应并发上限
+        self.metrics_port = metrics_port
+        self._metrics_runner = None
+        self.metrics = Metrics()
+        self.metrics.register_gauge('lb_in_flight_requests', lambda: {
+            (('target', target_id),): count for target_id, count in self.in_flight.items()})
+        self.metrics.register_gauge('lb_concurrency_limit', lambda: {
+            (('target', target_id),): limit.current for target_id, limit in self.concurrency_limits.items()})
+        self.metrics.register_gauge('lb_tokens_per_minute', lambda: {
+            (('target', target_id),): counter.count() for target_id, counter in self.token_counts.items()})
+        self.metrics.register_gauge('lb_queue_depth', lambda: {(): self.queue_depth})
+        if isinstance(response_cache, dict):
+            response_cache = ResponseCache(**response_cache)
+        self.response_cache = response_cache
+        self.single_flight = single_flight
+        self.flights = {}  # 进行中的单飞调用 {(请求哈希, 是否流式): SingleFlight}
+        self.model_aliases = dict(model_aliases or {})
+        self.groups = {}  # 模型路由表 {模型名: TargetGroup}，键 None 为不限模型的整个目标池
+        self.target_groups = {}  # 每个目标所属的分组 {目标ID: [TargetGroup]}
+        for target in self.targets:
+            self._add_target_state(target)
+            self.ready[target['id']] = target
+        self._build_groups()
+        self.config_path = config_path
+        self.config_reload_interval = config_reload_interval
+        self.state_path = state_path
+        self.state_save_interval = state_save_interval
+        # 快照的序列化与写文件在单独的线程中依次执行，不阻塞事件循环
+        self._state_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='state-writer') if state_path else None
+        self._config_mtime = os.stat(config_path).st_mtime_ns if config_path else None
+
+        # 统一使用 gpt-4-32k 的编码器，近似估算模式下不加载
+        self.encoder = None if approximate_tokens else tiktoken.get_encoding('cl100k_base')
+        self.token_counter = TokenCounter(self.encoder, approximate=approximate_tokens)
+
+    def _add_target_state(self, target):
+        """
+        为新目标创建按目标ID索引的限流、统计与熔断状态
+        :param target: 已填充缺省值的目标服务器字典
+        """
+        target_id = target['id']
+        self.target_map[target_id] = target
+        self.last_used[target_id] = 0
+        self.last_request[target_id] = 0
+        self.rps_counts[target_id] = self.limiter_backend.counter(f"{target_id}:rps", 1, 10)
+        self.request_counts[target_id] = self.limiter_backend.counter(f"{target_id}:rpm", 60, 60)
+        self.token_counts[target_id] = self.limiter_backend.counter(f"{target_id}:tpm", 60, 60)
+        self.load_counts[target_id] = SlidingWindowCounter(target.get('load_window', 60), 60)
+        self.next_eligible[target_id] = 0
+        self.latency[target_id] = LatencyTracker()
+        self.breakers[target_id] = CircuitBreaker(target)
+        self.upstream_limits[target_id] = UpstreamRateLimit()
+        self.in_flight[target_id] = 0
+        self.concurrency_limits[target_id] = AdaptiveConcurrencyLimit(
+            target['initial_concurrency'], target['min_concurrency'], target['max_concurrency'])
+
+    @staticmethod
+    def _target_models(target):
+        """
+        获取目标提供的对外模型名列表
+        """
+        return target['models'] or [target['model']]
+
+    def _build_groups(self):
+        """
+        按目标提供的模型重建路由表；同名分组保留轮询位置与等待队列，已不存在的模型分组中的等待者以 None 结束
+        """
+        weighted = self.algorithm == 'weighted_random'
+        ring = self.algorithm == 'prefix_affinity'
+        members = {None: list(self.targets)}
+        for target in self.targets:
+            for model in self._target_models(target):
+                members.setdefault(model, []).append(target)
+
+        old_groups, self.groups, self.target_groups = self.groups, {}, {}
+        for model, targets in members.items():
+            group = self.groups[model] = TargetGroup(model, targets, weighted, ring)
+            group.ready = {target['id']: target for target in targets if target['id'] in self.ready}
+            for target in targets:
+                self.target_groups.setdefault(target['id'], []).append(group)
+            old = old_groups.get(model)
+            if old is not None:
+                group.current_index = old.current_index % len(targets) if targets else 0
+                group.waiters, group.queue_depth = old.waiters, old.queue_depth
+        for model, old in old_groups.items():
+            if model not in self.groups:
+                for _, _, future, _, _ in old.waiters:
+                    if not future.done():
+                        future.set_result((None, None))
+
+    def resolve_model(self, model):
+        """
+        按请求中的模型名查找路由分组
+        :param model: 请求的模型名或别名，为空时使用整个目标池
+        :return: TargetGroup，没有目标提供该模型时返回 None
+        """
+        if not model:
+            return self.groups[None]
+        return self.groups.get(self.model_aliases.get(model, model))
+
+    def models(self):
+        """
+        获取可路由的模型名列表（含别名）
+        """
+        names = {model for model in self.groups if model is not None}
+        names.update(alias for alias, model in self.model_aliases.items() if model in self.groups)
+        return sorted(names)
+
+    def _drop_target_state(self, target_id):
+        """
+        删除已排空目标的全部状态，并关闭它的连接池
+        :param target_id: 目标ID
+        """
+        self.draining.pop(target_id, None)
+        for state in (self.last_used, self.last_request, self.rps_counts, self.request_counts, self.token_counts,
+                      self.load_counts, self.next_eligible, self.latency, self.breakers, self.upstream_limits,
+                      self.in_flight, self.concurrency_limits, self.target_groups):
+            state.pop(target_id, None)
+        session = self.sessions.pop(target_id, None)
+        if session is not None:
+            self._closing.append(asyncio.ensure_future(session.close()))
+        logger.info("Target %s drained and removed.", target_id, extra={'target': target_id})
+
+    def update_targets(self, targets):
+        """
+        原子地替换目标池：新增目标、移除目标并更新现有目标的权重与限流配置。
+        现有目标保留其滑动窗口、延迟统计与熔断状态（目标字典原地更新，进行中的请求看到的是同一个对象）；
+        被移除的目标立即停止接收新请求，在途请求结束后再删除其状态并关闭连接池。
+        :param targets: 新的目标列表，格式与构造函数相同
+        :return: {'added': [...], 'removed': [...], 'updated': [...]} 目标ID列表
+        """
+        new_targets = [{**self.default_config, **target} for target in targets]
+        new_ids = [target['id'] for target in new_targets]
+        if len(set(new_ids)) != len(new_ids):
+            raise ValueError('Target ids must be unique')
+        changes = {'added': [], 'removed': [], 'updated': []}
+
+        for target_id in list(self.target_map):
+            if target_id not in new_ids:
+                target = self.target_map.pop(target_id)
+                self.ready.pop(target_id, None)
+                self.next_eligible[target_id] = float('inf')  # 使冷却堆中的旧条目失效
+                changes['removed'].append(target_id)
+                if self.in_flight[target_id]:
+                    self.draining[target_id] = target
+                else:
+                    self._drop_target_state(target_id)
+
+        targets = []
+        for config in new_targets:
+            target_id = config['id']
+            target = self.target_map.get(target_id) or self.draining.pop(target_id, None)
+            if target is None:
+                target = config
+                self._add_target_state(target)
+                changes['added'].append(target_id)
+            else:
+                if target != config:
+                    if any(target[key] != config[key] for key in
+                           ('api_domain', 'connection_limit', 'dns_cache_ttl', 'keepalive_timeout')):
+                        session = self.sessions.pop(target_id, None)  # 连接参数变化，新请求使用新的连接池
+                        if session is not None:
+                            self._tasks.append(asyncio.ensure_future(self._close_when_idle(target_id, session)))
+                    target.clear()
+                    target.update(config)
+                    self.concurrency_limits[target_id].reconfigure(
+                        target['min_concurrency'], target['max_concurrency'])
+                    changes['updated'].append(target_id)
+                self.target_map[target_id] = target
+            targets.append(target)
+
+        self.targets = targets
+        self._build_groups()
+        current_time = time.time()
+        for target in targets:
+            self._schedule(target, current_time)
+        logger.info("Target pool updated: %s", changes)
+        return changes
+
+    async def _close_when_idle(self, target_id, session):
+        """
+        等待目标的在途请求结束后关闭被替换的旧连接池
+        """
+        try:
+            while self.in_flight.get(target_id):
+                await asyncio.sleep(1)
+        finally:
+            await session.close()
+
+    async def _config_watch_loop(self):
+        """
+        后台配置监视任务：按 config_reload_interval 检查配置文件的修改时间，变化后重新加载目标池；
+        文件无法解析（例如正在写入）时保留当前目标池，下一次检查时重试
+        """
+        while True:
+            await asyncio.sleep(self.config_reload_interval)
+            try:
+                mtime = os.stat(self.config_path).st_mtime_ns
+                if mtime == self._config_mtime:
+                    continue
+                config = load_config(self.config_path)
+                self.update_targets(config['targets'])
+                self._config_mtime = mtime
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error("Failed to reload config from %s: %s", self.config_path, e)
+
+    def _window_counters(self):
+        """
+        获取需要持久化的各类滑动窗口 {名称: {目标ID: 计数器}}
+        """
+        return {'rps': self.rps_counts, 'rpm': self.request_counts, 'tpm': self.token_counts, 'load': self.load_counts}
+
+    def snapshot_state(self):
+        """
+        导出各目标的运行状态：限流窗口、最近请求时间、熔断状态、从上游学习到的额度、并发上限与延迟统计。
+        只复制数值，开销与目标数和窗口桶数成正比，序列化交由 save_state 在后台线程完成
+        :return: 可 JSON 序列化的快照字典
+        """
+        current_time = time.time()
+        windows = self._window_counters()
+        targets = []
+        for target_id in self.target_map:
+            targets.append({
+                'id': target_id,
+                'last_request': self.last_request[target_id],
+                'last_used': self.last_used[target_id],
+                'windows': {name: counters[target_id].snapshot(current_time) for name, counters in windows.items()},
+                'breaker': self.breakers[target_id].snapshot(),
+                'upstream': self.upstream_limits[target_id].snapshot(),
+                'concurrency': self.concurrency_limits[target_id].snapshot(),
+                'latency': self.latency[target_id].snapshot()
+            })
+        return {'version': 1, 'saved_at': current_time, 'targets': targets}
+
+    def restore_state(self, snapshot):
+        """
+        恢复 snapshot_state() 导出的运行状态并重新调度对应目标。已不在目标池中的目标被忽略；
+        停机期间已过期的窗口桶与冷却自然失效；快照时间晚于当前时间（时钟回拨或来自其他主机）时，
+        快照中的所有时间整体平移到当前时间之前
+        :param snapshot: 快照字典
+        :return: 恢复了状态的目标数
+        """
+        current_time = time.time()
+        offset = min(0, current_time - snapshot['saved_at'])
+        windows = self._window_counters()
+        restored = 0
+        for state in snapshot['targets']:
+            target = self.target_map.get(state['id'])
+            if target is None:
+                continue
+            target_id = target['id']
+            self.last_request[target_id] = state['last_request'] + offset if state['last_request'] else 0
+            self.last_used[target_id] = state['last_used'] + offset if state['last_used'] else 0
+            for name, window in state['windows'].items():
+                if window is not None and name in windows:
+                    windows[name][target_id].restore(window, offset, current_time)
+            self.breakers[target_id].restore(state['breaker'], offset)
+            self.upstream_limits[target_id].restore(state['upstream'], offset)
+            self.concurrency_limits[target_id].restore(state['concurrency'])
+            self.latency[target_id].restore(state['latency'])
+            self._schedule(target, current_time)
+            restored += 1
+        return restored
+
+    def _write_state(self, snapshot):
+        # 在后台线程中执行：先写临时文件再原子替换，进程中途退出也不会留下半个快照
+        temp_path = f'{self.state_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp_path, self.state_path)
+
+    def _read_state(self):
+        with open(self.state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    async def save_state(self):
+        """
+        保存运行状态快照：在事件循环中复制状态，在后台线程中序列化并写入 state_path
+        """
+        if self._state_executor is None:
+            return
+        snapshot = self.snapshot_state()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._state_executor, self._write_state, snapshot)
+        except (OSError, ValueError) as e:
+            logger.error("Failed to save runtime state to %s: %s", self.state_path, e)
+
+    async def load_state(self):
+        """
+        从 state_path 恢复运行状态快照，文件不存在或无法解析时从空状态启动
+        :return: 恢复了状态的目标数
+        """
+        if self._state_executor is None or not os.path.exists(self.state_path):
+            return 0
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(self._state_executor, self._read_state)
+            restored = self.restore_state(snapshot)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("Failed to restore runtime state from %s: %s", self.state_path, e)
+            return 0
+        logger.info("Restored runtime state of %s targets from %s.", restored, self.state_path)
+        return restored
+
+    async def _state_save_loop(self):
+        """
+        后台状态保存任务：按 state_save_interval 定期保存运行状态快照
+        """
+        while True:
+            await asyncio.sleep(self.state_save_interval)
+            await self.save_state()
+
+    def _get_session(self, target):
+        """
+        获取目标服务器对应的长连接会话，不存在或已关闭时创建新的连接池
+        :param target: 目标服务器字典
+        :return: 该目标专用的 aiohttp.ClientSession
+        """
+        session = self.sessions.get(target['id'])
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=target['connection_limit'],
+                ttl_dns_cache=target['dns_cache_ttl'],
+                keepalive_timeout=target['keepalive_timeout']
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self.sessions[target['id']] = session
+        return session
+
+    async def _prewarm(self, target):
+        """
+        预热目标服务器的连接池，提前完成 DNS 解析与 TCP/TLS 握手
+        :param target: 目标服务器字典
+        """
+        session = self._get_session(target)
+
+        async def open_connection():
+            try:
+                async with session.head(target['api_domain']) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Failed to prewarm connection to %s: %s", target['id'], e, extra={'target': target['id']})
+
+        await asyncio.gather(*(open_connection() for _ in range(target['prewarm_connections'])))
+
+    async def start(self):
+        """
+        启动负载均衡器，为配置了 prewarm_connections 的目标预热连接；
+        使用最低延迟算法时同时启动后台延迟探测任务，设置了 config_path 时启动配置监视任务，
+        设置了 state_path 时先恢复上次保存的运行状态，再启动定期保存任务
+        """
+        if self.state_path:
+            await self.load_state()
+            self._tasks.append(asyncio.create_task(self._state_save_loop()))
+        await asyncio.gather(*(self._prewarm(target) for target in self.targets
+                               if target.get('prewarm_connections')))
+        if self.algorithm == 'lowest_latency':
+            self._tasks.append(asyncio.create_task(self._latency_probe_loop()))
+        if self.config_path:
+            self._tasks.append(asyncio.create_task(self._config_watch_loop()))
+        if self.metrics_port is not None:
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle_metrics)
+            self._metrics_runner = web.AppRunner(app)
+            await self._metrics_runner.setup()
+            await web.TCPSite(self._metrics_runner, '127.0.0.1', self.metrics_port).start()
+
+    async def aclose(self):
+        """
+        停止后台任务，保存运行状态快照并关闭所有目标的连接池
+        """
+        if self._wakeup_handle is not None:
+            self._wakeup_handle.cancel()
+            self._wakeup_handle = None
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+        tasks = self._tasks
+        self._tasks = []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *self._closing, return_exceptions=True)
+        self._closing = []
+        if self._state_executor is not None:
+            await self.save_state()
+            self._state_executor.shutdown()
+            self._state_executor = None
+        if self.response_cache is not None:
+            self.response_cache.close()
+        self.limiter_backend.close()
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        await asyncio.gather(*(session.close() for session in sessions))
+
+    async def handle_metrics(self, request):
         """
-        初始化负载均衡器
-        :param targets: 目标服务器列表，每个目标是一个包含各种配置的字典
-        :param algorithm: 负载均衡算法，可选 'round_robin'（轮询）, 'random'（随机）, 
-                          'weighted_random'（加权随机）, 'least_used'（最少使用）, 
-                          'dynamic_least_load'（动态最低负载）, 'lowest_latency'（最低延迟）
-        :param concurrency_limit: 并发请求数限制，默认值为10
+        以 Prometheus 文本格式返回指标的 HTTP 处理函数
         """
-        # 缺省值设置：为每个目标设置默认的流控和重试配置
-        default_config = {
-            'id': None,  # 目标的唯一标识符
-            'sk': 'sk-test',  # 默认的API密钥
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',  # 默认的User-Agent
-            'weight': 1,  # 默认的权重
-            'api_url': None,  # 默认的API URL（如果设置，将优先于api_domain）
-            'api_domain': 'https://api.oneapi.com',  # 默认的API域名
-            'model': 'gpt-4o-mini',  # 默认的模型名称，用于请求体中
-            'rps_limit': 2,  # 每秒请求数限制
-            'rpm_limit': 120,  # 每分钟请求数限制
-            'tpm_limit': 1000000,  # 每分钟内容令牌数限制
-            'mrr': 0.3,  # 最短请求间隔
-            'sri': 0.5,  # 成功到请求的间隔
-            '429_wait_time': 60,  # 触发429错误后的等待时间
-            '500_wait_time': 5,  # 触发500错误后的等待时间
-            '502_wait_time': 5,  # 触发502错误后的等待时间
-            '503_wait_time': 5,  # 触发503错误后的等待时间
-            '403_wait_time': 15,  # 触发403错误后的等待时间
-            'retry_wait_time': 3,  # 单请求任务重试等待时间
-            'max_retries': 2  # 单请求任务重试次数
-        }
+        return web.Response(text=self.metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
 
-        # 将缺省值应用到每个目标配置中
-        self.targets = [{**default_config, **target} for target in targets]
-        self.algorithm = algorithm
-        self.last_used = {target['id']: 0 for target in self.targets}  # 记录每个目标最后一次使用时间
-        self.request_counts = {target['id']: deque(maxlen=100) for target in self.targets}  # 记录每个目标的请求时间戳
-        self.token_counts = {target['id']: deque(maxlen=100) for target in self.targets}  # 记录每个目标的令牌使用情况
-        self.last_request_times = {target['id']: deque(maxlen=100) for target in self.targets}  # 初始化 last_request_times
-        self.lock = asyncio.Lock()  # 用于并发处理的异步锁
-        self.concurrency_limit = concurrency_limit  # 并发请求数限制
-        self.semaphore = asyncio.Semaphore(concurrency_limit)  # 异步信号量，用于限制并发数
-        self.current_index = 0  # 初始化轮询算法的索引
+    def effective_concurrency_limits(self):
+        """
+        获取各目标当前生效的自适应并发上限
+        :return: {目标ID: 并发上限}
+        """
+        return {target_id: limit.current for target_id, limit in self.concurrency_limits.items()}
+
+    def _finish_request(self, target):
+        """
+        结束一次已派发的请求（目标在 get_target 中被选中时计入在途请求），
+        释放该目标的并发占用并重新调度
+        :param target: 目标服务器字典
+        """
+        target_id = target['id']
+        self.in_flight[target_id] -= 1
+        if target_id in self.draining:
+            if not self.in_flight[target_id]:
+                try:
+                    # 推迟到本轮回调之后删除，让结束请求的调用方先完成成功/失败记账
+                    asyncio.get_running_loop().call_soon(self._drop_drained, target_id)
+                except RuntimeError:  # 事件循环已结束（如对象回收时），无需再排空
+                    pass
+            return
+        self._schedule(target)
+
+    def _abandon_dispatch(self, target, reservation=None):
+        """
+        放弃一次已派发但没有得到结果的请求（被取消、未发出或无人接收）：
+        释放令牌预留、归还半开试探名额后结束该请求，否则目标会一直停在半开状态、无法再被调度
+        :param target: 目标服务器字典
+        :param reservation: 派发时做的 TokenReservation
+        """
+        if reservation is not None:
+            self._settle_tokens(reservation, 0)
+        self.breakers[target['id']].release()
+        self._finish_request(target)
+
+    def _drop_drained(self, target_id):
+        if target_id in self.draining and not self.in_flight.get(target_id):
+            self._drop_target_state(target_id)
+
+    async def _acquire_slot(self, target, reservation=None):
+        """
+        占用一个全局并发名额（未设置合计上限时直接返回）；等待期间被取消时放弃该请求的派发
+        :param target: 目标服务器字典
+        :param reservation: 派发时做的 TokenReservation，放弃派发时一并释放
+        """
+        if self.semaphore is None:
+            return
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self._abandon_dispatch(target, reservation)
+            raise
+
+    def _release_slot(self, target):
+        """
+        归还全局并发名额并结束该请求
+        :param target: 目标服务器字典
+        """
+        if self.semaphore is not None:
+            self.semaphore.release()
+        self._finish_request(target)
+
+    @contextlib.asynccontextmanager
+    async def _request_slot(self, target, reservation=None):
+        await self._acquire_slot(target, reservation)
+        try:
+            yield
+        except BaseException:
+            self.breakers[target['id']].release()  # 请求被取消或异常中断，不会有结果，归还试探名额
+            raise
+        finally:
+            self._release_slot(target)
+
+    def _observe_latency(self, target, ttfb, total, stream=False):
+        """
+        记录一次成功请求的首字节时间与完整耗时
+        :param stream: 是否为流式请求；只有流式的首字节时间参与并发上限的延迟梯度判断
+        """
+        labels = (('target', target['id']),)
+        self.latency[target['id']].observe(ttfb, total)
+        self.concurrency_limits[target['id']].on_success(ttfb if stream else None, self.in_flight[target['id']])
+        self.metrics.observe('lb_time_to_first_token_seconds', ttfb, labels)
+        self.metrics.observe('lb_request_duration_seconds', total, labels)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
 
-        # 统一使用 gpt-4-32k 的编码器
-        self.encoder = tiktoken.get_encoding('cl100k_base')
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
 
-    async def _round_robin(self):
+    async def _round_robin(self, candidates, group):
         """
-        轮询算法实现
+        轮询算法实现，按分组内的顺序轮转，跳过不在候选中的目标
+        :param candidates: 当前可调度的目标列表
+        :param group: 候选目标所在的模型分组
         :return: 轮询选中的目标服务器
         """
-        target = self.targets[self.current_index]
-        self.current_index = (self.current_index + 1) % len(self.targets)
-        return target
+        candidate_ids = group.ready if len(candidates) == len(group.ready) else {target['id'] for target in candidates}
+        for _ in range(len(group.targets)):
+            target = group.targets[group.current_index]
+            group.current_index = (group.current_index + 1) % len(group.targets)
+            if target['id'] in candidate_ids:
+                return target
+        return candidates[0]
+
+    def _effective_weight(self, target, current_time):
+        """
+        计算目标的有效权重：配置权重 × 近期成功率 × 剩余额度比例（RPM/TPM/并发中最紧的一项）
+        :param target: 目标服务器字典
+        :param current_time: 当前时间戳
+        :return: 有效权重，两个调整系数均不低于 WEIGHT_FLOOR，保证恢复中的目标仍能分到少量流量
+        """
+        target_id = target['id']
+        breaker = self.breakers[target_id]
+        health = 1 - breaker.failures / len(breaker.outcomes) if breaker.outcomes else 1
+        headroom = 1 - self.in_flight[target_id] / self.concurrency_limits[target_id].current
+        if target.get('rpm_limit'):
+            headroom = min(headroom, 1 - self.request_counts[target_id].count(current_time) / target['rpm_limit'])
+        if target.get('tpm_limit'):
+            headroom = min(headroom, 1 - self.token_counts[target_id].count(current_time) / target['tpm_limit'])
+        return target.get('weight', 1) * max(health, self.WEIGHT_FLOOR) * max(headroom, self.WEIGHT_FLOOR)
+
+    def _set_ready(self, target, ready, current_time):
+        """
+        更新目标在就绪集合及其所属各模型分组中的状态，并同步分组的累积权重索引（不在就绪集合中的目标权重为0）
+        :param target: 目标服务器字典
+        :param ready: 是否可立即调度
+        :param current_time: 当前时间戳
+        """
+        target_id = target['id']
+        if ready:
+            self.ready[target_id] = target
+        else:
+            self.ready.pop(target_id, None)
+        weight = None
+        for group in self.target_groups.get(target_id, ()):
+            if ready:
+                group.ready[target_id] = target
+            else:
+                group.ready.pop(target_id, None)
+            if group.weight_index is not None:
+                if weight is None:
+                    weight = self._effective_weight(target, current_time) if ready else 0
+                group.weight_index.update(group.index[target_id], weight)
 
-    async def _weighted_random(self):
+    def _refresh_weights(self, group, current_time):
         """
-        加权随机算法实现
+        重建分组内全部目标的有效权重，使随时间滑出窗口而恢复的额度反映到权重中
+        """
+        group.weight_index.rebuild([self._effective_weight(target, current_time) if target['id'] in group.ready else 0
+                                    for target in group.targets])
+        group.weights_refreshed_at = current_time
+
+    async def _weighted_random(self, candidates, group):
+        """
+        加权随机算法实现：在分组的累积权重索引上二分抽样，权重按健康度与剩余额度动态调整
+        :param candidates: 当前可调度的目标列表
+        :param group: 候选目标所在的模型分组
         :return: 根据权重随机选中的目标服务器
         """
-        total_weight = sum(target.get('weight', 1) for target in self.targets)
-        r = random.uniform(0, total_weight)
-        for target in self.targets:
-            r -= target.get('weight', 1)
-            if r <= 0:
-                return target
+        current_time = time.time()
+        if current_time - group.weights_refreshed_at >= self.WEIGHT_REFRESH_INTERVAL:
+            self._refresh_weights(group, current_time)
+        if len(candidates) == len(group.ready):
+            index = group.weight_index.sample()
+            if index is not None:
+                return group.targets[index]
+            return random.choice(candidates)
 
-    async def _least_used(self):
+        # 排除了部分就绪目标（如对冲请求），只在剩余候选中按有效权重抽样
+        weights = [group.weight_index.weights[group.index[target['id']]] for target in candidates]
+        if not sum(weights):
+            return random.choice(candidates)
+        return random.choices(candidates, weights)[0]
+
+    async def _least_used(self, candidates):
         """
         最少使用算法实现
+        :param candidates: 当前可调度的目标列表
         :return: 最近最少使用的目标服务器
         """
-        return min(self.targets, key=lambda x: self.last_used[x['id']])
+        return min(candidates, key=lambda x: self.last_used[x['id']])
 
-    async def _dynamic_least_load(self):
+    async def _dynamic_least_load(self, candidates):
         """
         动态最低负载算法实现
+        :param candidates: 当前可调度的目标列表
         :return: 负载最小的目标服务器
         """
         current_time = time.time()
         loads = []
-        for target in self.targets:
-            window = target.get('load_window', 60)  # 默认1分钟窗口
-            # 计算窗口期内的请求数
-            requests_in_window = sum(1 for t in self.last_request_times[target['id']]
-                                    if current_time - t <= window)
+        for target in candidates:
+            # 计算窗口期内的请求数（窗口长度由 load_window 指定，默认1分钟）
+            requests_in_window = self.load_counts[target['id']].count(current_time)
             
             # 计算 RPS 限制 * 60 和 RPM 限制的较小值
             rps_limit = target.get('rps_limit', float('inf')) * 60
@@ -114,143 +2332,478 @@ class LoadBalancer:
         # 返回负载最小的目标服务器
         return min(loads, key=lambda x: x[1])[0]
 
-    async def _lowest_latency(self):
+    async def _lowest_latency(self, candidates):
         """
-        最低延迟算法实现
+        最低延迟算法实现，直接读取后台探测与真实请求共同维护的延迟估计
+        :param candidates: 当前可调度的目标列表
         :return: 延迟最小的目标服务器
         """
-        latencies = [await self._get_latency(target) for target in self.targets]
-        return min(latencies, key=lambda x: x[1])[0]
+        return min(candidates, key=lambda x: self.latency[x['id']].estimate())
 
     async def _get_latency(self, target):
         """
-        获取目标服务器的延迟
+        探测目标服务器的延迟
         :param target: 目标服务器字典
         :return: 目标服务器和延迟值的元组
         """
-        start_time = time.time()
+        start_time = time.monotonic()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(target.get('latency_check_url', target['api_domain'])):
-                    return target, time.time() - start_time
-        except:
+            session = self._get_session(target)
+            async with session.get(target.get('latency_check_url', target['api_domain'])):
+                return target, time.monotonic() - start_time
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             return target, float('inf')
 
-    async def _check_target_availability(self, target):
+    async def _latency_probe_loop(self):
         """
-        检查目标服务器是否可用，基于流控策略
+        后台延迟探测任务：按各目标的 latency_probe_interval 并发探测，结果写入延迟统计
+        """
+        next_probe = {}
+        while True:
+            current_time = time.monotonic()
+            due = [target for target in self.targets if target.get('latency_probe_interval')
+                   and next_probe.get(target['id'], 0) <= current_time]
+            for target, latency in await asyncio.gather(*(self._get_latency(target) for target in due)):
+                self.latency[target['id']].observe_probe(latency)
+                next_probe[target['id']] = current_time + target['latency_probe_interval']
+            intervals = [target['latency_probe_interval'] for target in self.targets if target.get('latency_probe_interval')]
+            await asyncio.sleep(min(intervals, default=30))
+
+    def _next_eligible_time(self, target, current_time):
+        """
+        计算目标服务器下一次可被调度的时间，综合 RPS/RPM/TPM/MRR/SRI 及错误冷却
         :param target: 目标服务器字典
-        :return: 如果可用返回True，否则返回False
+        :param current_time: 当前时间戳
+        :return: (可调度时间, 限制原因) 元组，原因为 RPS/RPM/TPM/MRR/SRI/concurrency/cooldown，可立即调度时为 None
         """
-        current_time = time.time()
         target_id = target['id']
+        eligible_at, reason = current_time, None
+        last_request = self.last_request[target_id]
+
+        def defer(until, cause):
+            nonlocal eligible_at, reason
+            if until > eligible_at:
+                eligible_at, reason = until, cause
 
-        # 检查每秒请求数限制（RPS）
-        if target.get('rps_limit'):
-            if len(self.last_request_times[target_id]) > 0 and current_time - self.last_request_times[target_id][-1] < 1 / target['rps_limit']:
-                logging.warning(f"Target {target_id} is unavailable due to RPS limit.")
-                return False
+        # 检查每秒请求数限制（RPS）：不足1的限制按请求间隔处理，否则使用1秒滑动窗口
+        rps_limit = target.get('rps_limit')
+        if rps_limit and rps_limit < 1:
+            if last_request:
+                defer(last_request + 1 / rps_limit, 'RPS')
+        elif rps_limit:
+            count = self.rps_counts[target_id].count(current_time)
+            if count >= rps_limit:
+                defer(self.rps_counts[target_id].expiry(count - rps_limit + 1, current_time), 'RPS')
 
-        # 检查每分钟请求数限制（RPM）
+        # 检查每分钟请求数限制（RPM）：窗口已满时，等到足够多的旧请求滑出窗口
         if target.get('rpm_limit'):
-            requests_in_last_minute = sum(1 for t in self.last_request_times[target_id]
-                                        if current_time - t <= 60)
-            if requests_in_last_minute >= target['rpm_limit']:
-                logging.warning(f"Target {target_id} is unavailable due to RPM limit.")
-                return False
+            count = self.request_counts[target_id].count(current_time)
+            if count >= target['rpm_limit']:
+                defer(self.request_counts[target_id].expiry(count - target['rpm_limit'] + 1, current_time), 'RPM')
 
-        # 检查每分钟令牌数限制（TPM）
+        # 检查每分钟令牌数限制（TPM）：窗口已满时，等到足够多的令牌滑出窗口
         if target.get('tpm_limit'):
-            # 计算过去一分钟的令牌数总和
-            token_count_in_last_minute = sum(tokens for tokens, timestamp in self.token_counts[target_id]
-                                            if current_time - timestamp <= 60)
-            if token_count_in_last_minute >= target['tpm_limit']:
-                logging.warning(f"Target {target_id} is unavailable due to TPM limit.")
-                return False
+            tokens = self.token_counts[target_id].count(current_time)
+            if tokens >= target['tpm_limit']:
+                defer(self.token_counts[target_id].expiry(tokens - target['tpm_limit'] + 1, current_time), 'TPM')
 
         # 检查最短请求间隔（MRR）
-        if target.get('mrr'):
-            if len(self.last_request_times[target_id]) > 0 and current_time - self.last_request_times[target_id][-1] < target['mrr']:
-                logging.warning(f"Target {target_id} is unavailable due to MRR limit.")
-                return False
+        if target.get('mrr') and last_request:
+            defer(last_request + target['mrr'], 'MRR')
 
         # 检查成功到请求的间隔（SRI）
-        if target.get('sri'):
-            if self.last_used[target_id] and current_time - self.last_used[target_id] < target['sri']:
-                logging.warning(f"Target {target_id} is unavailable due to SRI limit.")
-                return False
-
-        # 检查各种错误的等待时间
-        for error_code in [429, 500, 502, 503, 403]:
-            if target.get(f'{error_code}_wait_time'):
-                last_error_time = getattr(self, f'last_{error_code}_time', {}).get(target_id, 0)
-                if last_error_time + target[f'{error_code}_wait_time'] > current_time:
-                    logging.warning(f"Target {target_id} is unavailable due to {error_code} wait time.")
-                    return False
+        if target.get('sri') and self.last_used[target_id]:
+            defer(self.last_used[target_id] + target['sri'], 'SRI')
 
+        # 检查自适应并发上限：在途请求已满时等待请求结束后由 _finish_request 重新调度
+        if self.in_flight[target_id] >= self.concurrency_limits[target_id].current:
+            defer(float('inf'), 'concurrency')
+
+        # 检查从上游响应头学习到的剩余额度
+        upstream_at, upstream_reason = self.upstream_limits[target_id].available_at(current_time)
+        if upstream_reason:
+            defer(upstream_at, upstream_reason)
+
+        # 检查熔断器状态（错误冷却、失败率熔断与半开试探）
+        breaker = self.breakers[target_id]
+        defer(breaker.available_at(current_time), 'cooldown')
+
+        return eligible_at, reason
+
+    async def _check_target_availability(self, target):
+        """
+        检查目标服务器是否可用，基于流控策略
+        :param target: 目标服务器字典
+        :return: 如果可用返回True，否则返回False
+        """
+        eligible_at, reason = self._next_eligible_time(target, time.time())
+        if reason is not None:
+            logger.warning("Target %s is unavailable due to %s limit.", target['id'], reason,
+                           extra={'target': target['id'], 'reason': reason})
+            return False
         return True
 
-    async def get_target(self):
+    def _schedule(self, target, current_time=None):
+        """
+        重新计算目标的可调度时间：已可用则放入就绪集合，否则按可调度时间压入冷却堆
+        :param target: 目标服务器字典
+        :param current_time: 当前时间戳，缺省为 time.time()
+        """
+        target_id = target['id']
+        if target_id not in self.target_map:
+            return  # 已从目标池移除
+        current_time = time.time() if current_time is None else current_time
+        eligible_at, reason = self._next_eligible_time(target, current_time)
+        self.next_eligible[target_id] = eligible_at
+        if eligible_at <= current_time:
+            self._set_ready(target, True, current_time)
+            if self.queue_depth:
+                self._notify_waiters()
+            return
+
+        self.metrics.inc('lb_availability_rejections_total', (('target', target_id), ('reason', reason)))
+        self._set_ready(target, False, current_time)
+        if eligible_at != float('inf'):  # 为 inf 时等待在途请求结束或半开试探结果，届时重新调度
+            heapq.heappush(self.cooling, (eligible_at, next(self._schedule_seq), target_id))
+            if self.queue_depth:
+                self._arm_wakeup(eligible_at)
+
+    def _promote_ready(self, current_time):
+        """
+        将冷却堆中已到期的目标移回就绪集合，过期的堆条目（已被重新调度）直接丢弃
+        :param current_time: 当前时间戳
+        """
+        while self.cooling and self.cooling[0][0] <= current_time:
+            eligible_at, _, target_id = heapq.heappop(self.cooling)
+            if self.next_eligible.get(target_id) == eligible_at and target_id not in self.ready:
+                self._schedule(self.target_map[target_id], current_time)
+
+    def next_ready_time(self):
+        """
+        获取最早有目标重新可用的时间
+        :return: 时间戳；已有就绪目标时返回当前时间，没有任何待调度目标时返回 None
+        """
+        current_time = time.time()
+        self._promote_ready(current_time)
+        if self.ready:
+            return current_time
+        return self._next_cooling_time()
+
+    def _next_cooling_time(self):
+        """
+        获取冷却堆中最早的有效可调度时间，没有冷却中的目标时返回 None
+        """
+        while self.cooling:
+            eligible_at, _, target_id = self.cooling[0]
+            if self.next_eligible.get(target_id) == eligible_at:
+                return eligible_at
+            heapq.heappop(self.cooling)
+        return None
+
+    def _mark_dispatched(self, target, current_time):
+        """
+        记录目标被选中发出请求，并立即按 RPS/MRR 等限制重新调度
+        :param target: 目标服务器字典
+        :param current_time: 当前时间戳
+        """
+        target_id = target['id']
+        self.last_request[target_id] = current_time  # 记录请求时间戳
+        self.rps_counts[target_id].add(1, current_time)
+        self.request_counts[target_id].add(1, current_time)
+        self.load_counts[target_id].add(1, current_time)
+        self.upstream_limits[target_id].consume(requests=1)
+        self.breakers[target_id].on_dispatch(current_time)
+        self.in_flight[target_id] += 1
+        self._schedule(target, current_time)
+
+    def _affinity_key(self, request_data):
         """
-        获取当前可用的目标服务器
+        计算请求的前缀亲和键，只有前缀亲和算法需要
+        :return: 亲和键，其他算法或请求没有消息时返回 None
+        """
+        if self.algorithm != 'prefix_affinity':
+            return None
+        return prefix_affinity_key(request_data, self.affinity_prefix_chars)
+
+    async def _prefix_affinity(self, candidates, group, affinity_key):
+        """
+        前缀亲和算法实现：有界负载的一致性哈希。从亲和键在环上的位置顺时针查找，
+        选择第一个可调度且在途请求数未超过上限（分组平均值的 affinity_load_factor 倍）的目标，
+        首选目标饱和或冷却时溢出到环上的下一个目标，同一前缀的溢出顺序保持稳定
+        :param candidates: 当前可调度的目标列表
+        :param group: 候选目标所在的模型分组
+        :param affinity_key: 请求的亲和键，为 None 时退化为随机选择
         :return: 选中的目标服务器字典
         """
-        async with self.lock:
-            for attempt in range(3):  # 尝试次数
-                # 根据选择的算法获取目标
-                if self.algorithm == 'round_robin':
-                    target = await self._round_robin()
-                elif self.algorithm == 'random':
-                    target = random.choice(self.targets)
-                elif self.algorithm == 'weighted_random':
-                    target = await self._weighted_random()
-                elif self.algorithm == 'least_used':
-                    target = await self._least_used()
-                elif self.algorithm == 'dynamic_least_load':
-                    target = await self._dynamic_least_load()
-                elif self.algorithm == 'lowest_latency':
-                    target = await self._lowest_latency()
-                else:
-                    raise ValueError("Invalid algorithm")
+        if affinity_key is None or not group.ring_points:
+            return random.choice(candidates)
+        available = {target['id']: target for target in candidates}
+        total = sum(self.in_flight[target['id']] for target in group.targets) + 1  # 包含本次请求
+        bound = math.ceil(self.affinity_load_factor * total / len(group.targets))
+        position = bisect.bisect(group.ring_points, affinity_key)
+        visited = []
+        for offset in range(len(group.ring_targets)):
+            target_id = group.ring_targets[(position + offset) % len(group.ring_targets)]
+            if target_id in visited:
+                continue
+            visited.append(target_id)
+            if target_id in available and self.in_flight[target_id] < bound:
+                if len(visited) > 1:  # 首选目标冷却或已饱和
+                    self.metrics.inc('lb_affinity_spills_total', (('target', visited[0]),))
+                return available[target_id]
+            if len(visited) == len(group.targets):
+                break
+        # 所有可调度目标都已达到负载上限，选择在途请求最少的目标
+        return min(candidates, key=lambda target: self.in_flight[target['id']])
 
-                if await self._check_target_availability(target):
-                    logging.info(f"Selected target: {target['id']} with API Domain: {target['api_domain']}")
+    def _pick_ready(self, group, current_time):
+        """
+        不构建候选列表，直接在分组的选择结构上抽取一个就绪目标：加权随机在累积权重索引上 O(log n) 抽样，
+        轮询从游标处找下一个就绪目标，随机在分组位置上拒绝抽样。其余算法需要比较全部就绪目标，返回 None
+        :param group: TargetGroup
+        :param current_time: 当前时间戳
+        :return: 抽中的就绪目标，未抽中时返回 None，由调用方扫描候选
+        """
+        if not group.ready:
+            return None
+        if self.algorithm == 'weighted_random':
+            if current_time - group.weights_refreshed_at >= self.WEIGHT_REFRESH_INTERVAL:
+                self._refresh_weights(group, current_time)
+            index = group.weight_index.sample()
+            return None if index is None else group.targets[index]
+        if self.algorithm == 'round_robin':
+            for _ in range(len(group.targets)):
+                target = group.targets[group.current_index]
+                group.current_index = (group.current_index + 1) % len(group.targets)
+                if target['id'] in group.ready:
                     return target
-                else:
-                    logging.warning(f"Target {target['id']} is currently unavailable. Retrying... ({attempt + 1}/3)")
-                    await asyncio.sleep(0.1)  # 如果目标不可用，等待一段时间后再重试
+        elif self.algorithm == 'random':
+            for _ in range(self.RANDOM_PICK_ATTEMPTS):
+                target = random.choice(group.targets)
+                if target['id'] in group.ready:
+                    return target
+        return None
+
+    async def _select(self, candidates, group, affinity_key=None):
+        """
+        按配置的负载均衡算法从候选目标中选出一个
+        :param candidates: 当前可调度的目标列表
+        :param group: 候选目标所在的模型分组
+        :param affinity_key: 请求的前缀亲和键，只有前缀亲和算法使用
+        :return: 选中的目标服务器字典
+        """
+        if self.algorithm == 'round_robin':
+            return await self._round_robin(candidates, group)
+        elif self.algorithm == 'random':
+            return random.choice(candidates)
+        elif self.algorithm == 'weighted_random':
+            return await self._weighted_random(candidates, group)
+        elif self.algorithm == 'least_used':
+            return await self._least_used(candidates)
+        elif self.algorithm == 'dynamic_least_load':
+            return await self._dynamic_least_load(candidates)
+        elif self.algorithm == 'lowest_latency':
+            return await self._lowest_latency(candidates)
+        elif self.algorithm == 'prefix_affinity':
+            return await self._prefix_affinity(candidates, group, affinity_key)
+        else:
+            raise ValueError("Invalid algorithm")
 
-            logging.error("All targets are currently unavailable after multiple attempts.")
+    async def get_target(self, exclude=None, model=None, affinity_key=None):
+        """
+        获取当前可用的目标服务器。
+        调度器只在就绪集合中选择目标，冷却中的目标按可调度时间保存在最小堆里，
+        选择过程不持有锁、不休眠，选中后立即记录派发并重新调度。
+        :param exclude: 不参与本次选择的目标ID集合
+        :param model: 请求的模型名或别名，只在提供该模型的目标中选择；为空时在整个目标池中选择
+        :param affinity_key: 请求的前缀亲和键（见 prefix_affinity_key），只有前缀亲和算法使用
+        :return: 选中的目标服务器字典，暂无可用目标或没有目标提供该模型时返回 None
+        """
+        group = self.resolve_model(model)
+        if group is None:
+            logger.error("No target serves model %s.", model)
             return None
+        target, _ = await self._get_target_from(group, exclude, affinity_key)
+        return target
+
+    def _token_fit_time(self, target, tokens, current_time):
+        """
+        计算目标的 TPM 窗口能容纳 tokens 个预留令牌的时间；预留超过整个额度时，等到窗口清空
+        :param target: 目标服务器字典
+        :param tokens: 预留令牌数
+        :param current_time: 当前时间戳
+        :return: 时间戳，现在即可容纳时返回 current_time
+        """
+        limit = target.get('tpm_limit')
+        if not limit:
+            return current_time
+        counter = self.token_counts[target['id']]
+        excess = counter.count(current_time) + min(tokens, limit) - limit
+        return current_time if excess <= 0 else counter.expiry(excess, current_time)
+
+    async def _get_target_from(self, group, exclude=None, affinity_key=None, demand=None):
+        """
+        在模型分组的就绪目标中选择并派发一个目标。
+        轮询、随机与加权随机算法先用 _pick_ready 直接抽取目标，抽中的目标可用时不遍历就绪集合；
+        抽中的目标被排除或 TPM 窗口容纳不下预留时，以及需要比较全部就绪目标的算法（最少使用、最低负载、
+        最低延迟、前缀亲和），才扫描就绪目标构建候选列表，开销与分组内就绪目标数成正比。
+        给出令牌需求时只选择 TPM 窗口容纳得下预留的目标，并在记录派发的同时预留令牌；
+        都容纳不下时返回空结果，请求在等待队列中等到窗口有足够的余量
+        :param group: TargetGroup
+        :param exclude: 不参与本次选择的目标ID集合
+        :param affinity_key: 请求的前缀亲和键
+        :param demand: 令牌需求 (请求数据, 提示令牌数)，为 None 时不预留
+        :return: (选中的目标服务器字典, TokenReservation)，暂无可用目标时返回 (None, None)
+        """
+        selection_start = time.perf_counter()
+        self._promote_ready(time.time())
+        group.tokens_available_at = None
+        for _ in range(len(group.targets)):
+            current_time = time.time()
+            target = self._pick_ready(group, current_time)
+            if target is None or (exclude and target['id'] in exclude) or (demand is not None and self._token_fit_time(
+                    target, self._reservation_size(target, *demand), current_time) > current_time):
+                candidates = []
+                for target in group.ready.values():
+                    if exclude and target['id'] in exclude:
+                        continue
+                    if demand is not None:
+                        fit_at = self._token_fit_time(target, self._reservation_size(target, *demand), current_time)
+                        if fit_at > current_time:
+                            group.tokens_available_at = min(fit_at, group.tokens_available_at or fit_at)
+                            continue
+                    candidates.append(target)
+                if not candidates:
+                    break
+                target = await self._select(candidates, group, affinity_key)
+            current_time = time.time()
+            reservation = None
+            # 共享额度时，其他进程可能已用掉额度，检查、记录派发与预留令牌需原子完成
+            with self.limiter_backend.lock():
+                dispatched = target['id'] in group.ready and await self._check_target_availability(target)
+                if dispatched and demand is not None:
+                    tokens = self._reservation_size(target, *demand)
+                    dispatched = self._token_fit_time(target, tokens, current_time) <= current_time
+                if dispatched:
+                    self._mark_dispatched(target, current_time)
+                    if demand is not None:
+                        reservation = self._reserve_tokens(target, tokens, current_time)
+            if dispatched:
+                self.metrics.observe('lb_selection_seconds', time.perf_counter() - selection_start)
+                logger.debug("Selected target: %s with API Domain: %s", target['id'], target['api_domain'])
+                return target, reservation
+            # 目标在选择期间已被占用或状态已变化，重新调度后从剩余就绪目标中继续选择
+            self._schedule(target, current_time)
+            self._promote_ready(current_time)
+
+        self.metrics.observe('lb_selection_seconds', time.perf_counter() - selection_start)
+        if group.tokens_available_at is not None:
+            logger.warning("No target for model %s has TPM headroom for the request.", group.model or '*')
+        else:
+            logger.warning("All targets for model %s are currently cooling down.", group.model or '*')
+        return None, None
 
 
     async def report_success(self, target, token_count):
         """
         报告请求成功，更新相关状态
         :param target: 目标服务器字典
-        :param token_count: 本次请求使用的令牌数
+        :param token_count: 本次请求使用的令牌数（已在预留与结算时计入 TPM 窗口，这里只用于日志）
         """
         target_id = target['id']
         self.last_used[target_id] = time.time()  # 更新最后使用时间
-        self.request_counts[target_id].append(time.time())  # 记录请求时间
-        self.token_counts[target_id].append((token_count, time.time()))  # 记录令牌数和时间戳
-        self.last_request_times[target_id].append(time.time())  # 记录请求时间戳
-        logging.info(f"Request to {target_id} succeeded with {token_count} tokens used.")
+        self.breakers[target_id].record_success()
+        self.metrics.inc('lb_requests_total', (('target', target_id), ('outcome', 'success')))
+        self._schedule(target)
+        logger.debug("Request to %s succeeded with %s tokens used.", target_id, token_count,
+                     extra={'target': target_id})
 
-    async def report_failure(self, target, status_code):
+    async def report_failure(self, target, status_code, retry_after=None):
         """
         报告请求失败，记录错误码及时间
         :param target: 目标服务器字典
         :param status_code: 请求失败时的HTTP状态码
+        :param retry_after: 上游 Retry-After 响应头给出的等待时间（秒）
         """
         target_id = target['id']
         current_time = time.time()
-        if status_code in [429, 500, 502, 503, 403]:
-            # 根据错误码记录最后触发时间
-            setattr(self, f'last_{status_code}_time', {**getattr(self, f'last_{status_code}_time', {}), target_id: current_time})
-        logging.error(f"Request to {target_id} failed with status code {status_code}.")
+        self.breakers[target_id].record_failure(status_code, current_time, retry_after)
+        if status_code in (429, 500, 502, 503, 0):
+            self.concurrency_limits[target_id].on_drop()
+        self.metrics.inc('lb_requests_total', (('target', target_id), ('outcome', str(status_code))))
+        self._schedule(target, current_time)
+        logger.error("Request to %s failed with status code %s.", target_id, status_code,
+                     extra={'target': target_id, 'status': status_code})
+
+    def _learn_rate_limits(self, target, response):
+        """
+        从响应头更新目标的上游额度
+        :param target: 目标服务器字典
+        :param response: aiohttp 响应
+        :return: 错误响应的 Retry-After 等待时间（秒），没有时返回 None
+        """
+        current_time = time.time()
+        self.upstream_limits[target['id']].update(response.headers, current_time)
+        if response.status == 200:
+            return None
+        return parse_retry_after(response.headers, current_time)
+
+    def _reservation_size(self, target, request_data, token_count):
+        """
+        计算请求需要在 TPM 窗口中预留的令牌数：提示令牌数 + 每个结果的最大补全令牌数
+        :param target: 目标服务器字典
+        :param request_data: 请求的数据
+        :param token_count: 提示令牌数
+        :return: 预留令牌数
+        """
+        max_tokens = request_data.get('max_completion_tokens') or request_data.get('max_tokens')
+        if not isinstance(max_tokens, int) or max_tokens <= 0:
+            max_tokens = target['completion_tokens_reserve']
+        choices = request_data.get('n')
+        return token_count + max_tokens * (choices if isinstance(choices, int) and choices > 0 else 1)
+
+    def _reserve_tokens(self, target, tokens, current_time=None):
+        """
+        在目标的 TPM 窗口与上游额度中预留令牌
+        :return: TokenReservation
+        """
+        current_time = time.time() if current_time is None else current_time
+        self.token_counts[target['id']].add(tokens, current_time)
+        self.upstream_limits[target['id']].consume(tokens=tokens)
+        return TokenReservation(target['id'], tokens, current_time)
+
+    def _settle_tokens(self, reservation, used):
+        """
+        按实际用量结算令牌预留，多退少补记到预留时的窗口桶中，释放的额度立即可用
+        :param reservation: TokenReservation
+        :param used: 实际使用的令牌数，为 None 时保留全部预留
+        """
+        if reservation.settled:
+            return
+        reservation.settled = True
+        counter = self.token_counts.get(reservation.target_id)
+        if used is None or counter is None or used == reservation.tokens:
+            return
+        counter.adjust(used - reservation.tokens, reservation.reserved_at)
+        target = self.target_map.get(reservation.target_id)
+        if target is not None and used < reservation.tokens:
+            self._schedule(target)  # 释放的额度可能让目标重新可用
 
-    async def send_request(self, target, request_data):
+    async def send_request(self, target, request_data, stream=False, token_count=None, first_byte=None,
+                           reservation=None):
+        """
+        向目标服务器发送请求，失败时按目标配置重试
+        :param target: 目标服务器字典
+        :param request_data: 请求的数据
+        :param stream: 是否以流式（SSE）方式返回
+        :param token_count: 请求的提示令牌数，缺省时在此计算；发出前按它与 max_tokens 预留 TPM 额度，
+                            成功后按响应中的 usage 结算，失败时释放预留
+        :param first_byte: 可选的 asyncio.Event，收到成功响应的首字节时置位
+        :param reservation: 派发目标时已做的 TokenReservation（process_request 在选择目标时预留），
+                            为 None 时在取得并发名额后预留
+        :return: 非流式时为响应 JSON；流式时为 StreamResponse；失败返回 None
+        :raises UpstreamError: 上游以客户端错误拒绝了请求
+        """
         headers = {
             'Authorization': f"Bearer {target['sk']}",
             'User-Agent': target.get('user_agent', 'LoadBalancer/1.0'),
@@ -263,72 +2816,599 @@ class LoadBalancer:
         else:
             url = target['api_url']
 
-        logging.debug(f"Constructed URL for request: {url}")
+        # 按目标的模型映射填入上游模型名；请求未指定模型（或目标不提供该模型）时使用目标配置的 model。
+        # 复制一层请求体，调用方的 model 字段保持对外模型名，改投其他目标时仍可按它路由
+        model = request_data.get('model')
+        model = self.model_aliases.get(model, model)
+        if model in self._target_models(target):
+            model = (target['model_map'] or {}).get(model, model)
+        else:
+            model = target['model']
+        request_data = {**request_data, 'model': model}
 
-        # 在请求数据中填入 model 字段
-        request_data['model'] = target['model']
+        # 计算请求数据的令牌数（process_request 已计算时直接复用）
+        if token_count is None:
+            token_count = await self.token_counter.count(request_data)
+        reserved_tokens = self._reservation_size(target, request_data, token_count)
 
-        # 计算请求数据的令牌数
-        token_count = len(self.encoder.encode(str(request_data)))
+        session = self._get_session(target)  # 复用该目标的长连接池
+        if stream:
+            return await self._send_stream_request(target, session, url, headers, request_data, reserved_tokens,
+                                                   reservation)
 
-        async with self.semaphore:  # 使用信号量控制并发
-            async with aiohttp.ClientSession() as session:
-                for attempt in range(target.get('max_retries', 3)):  # 根据最大重试次数进行重试
-                    try:
-                        logging.debug(f"Sending request to {url} with data: {request_data}")
-                        async with session.post(url, json=request_data, headers=headers) as response:
+        client_error = None
+        async with self._request_slot(target, reservation):  # 使用信号量控制并发
+            if reservation is None:
+                reservation = self._reserve_tokens(target, reserved_tokens)  # 取得名额、即将发出时才预留
+            for attempt in range(target.get('max_retries', 3)):  # 根据最大重试次数进行重试
+                try:
+                    if self.log_payloads:
+                        logger.debug("Sending request to %s with data: %s", url, request_data)
+                    start_time = time.monotonic()
+                    async with session.post(url, json=request_data, headers=headers) as response:
+                        ttfb = time.monotonic() - start_time  # 收到响应头即视为首字节
+                        retry_after = self._learn_rate_limits(target, response)
+                        if first_byte is not None and response.status == 200:
+                            first_byte.set()
+                        if response.status == 200:  # 请求成功
+                            response_data = await response.json()
+                            used_tokens = usage_total_tokens(response_data)
+                            self._settle_tokens(reservation, used_tokens)
+                            self._observe_latency(target, ttfb, time.monotonic() - start_time)
+                            await self.report_success(target, used_tokens or reserved_tokens)
+                            if self.log_payloads:
+                                logger.debug("Received response from %s: %s", url, response_data)
+                            return response_data
+                        else:
                             response_data = await response.text()
-                            if response.status == 200:  # 请求成功
-                                await self.report_success(target, token_count)
-                                logging.debug(f"Received response from {url}: {response_data}")
-                                return await response.json()
-                            else:
-                                await self.report_failure(target, response.status)  # 记录失败
-                                logging.debug(f"Received error response from {url}: {response_data}")
-                                if response.status not in [429, 500, 502, 503, 403]:
-                                    return None
-                    except aiohttp.ClientError as e:
-                        await self.report_failure(target, 0)  # 客户端错误，记录为0
-                        logging.error(f"ClientError during request to {url}: {str(e)}")
-
-                    await asyncio.sleep(target.get('retry_wait_time', 1))  # 重试前等待
+                            await self.report_failure(target, response.status, retry_after)  # 记录失败
+                            logger.debug("Received error response from %s: %s", url, response_data)
+                            if response.status in CLIENT_ERROR_STATUSES:
+                                client_error = UpstreamError.from_text(response.status, response_data)
+                            if response.status not in [429, 500, 502, 503, 403]:
+                                break
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    await self.report_failure(target, 0)  # 客户端错误、超时或响应体不是合法 JSON，记录为0
+                    logger.error("ClientError during request to %s: %s", url, e, extra={'target': target['id']})
+
+                if self.breakers[target['id']].state != 'closed':
+                    break  # 目标已熔断，不再在该目标上重试
 
+                await asyncio.sleep(target.get('retry_wait_time', 1))  # 重试前等待
+
+            self._settle_tokens(reservation, 0)  # 请求最终失败，释放预留
+        if client_error is not None:
+            raise client_error
         return None
 
 
-    async def process_request(self, request_data):
+    async def _send_stream_request(self, target, session, url, headers, request_data, reserved_tokens,
+                                   reservation=None):
+        """
+        发送流式请求：在收到第一个 SSE 事件之前可以重试，之后交由 StreamResponse 逐个转发
+        :return: StreamResponse，失败返回 None
+        """
+        await self._acquire_slot(target, reservation)  # 并发名额随 StreamResponse 一起移交，在流关闭时释放
+        stream = None
+        client_error = None
+        try:
+            if reservation is None:
+                reservation = self._reserve_tokens(target, reserved_tokens)  # 令牌预留同样移交给 StreamResponse 结算
+            for attempt in range(target.get('max_retries', 3)):
+                response = None
+                try:
+                    if self.log_payloads:
+                        logger.debug("Sending streaming request to %s with data: %s", url, request_data)
+                    start_time = time.monotonic()
+                    response = await session.post(url, json=request_data, headers=headers)
+                    retry_after = self._learn_rate_limits(target, response)
+                    if response.status == 200:
+                        first_event = await read_sse_event(response.content)
+                        if first_event is not None:
+                            stream = StreamResponse(self, target, response, first_event, start_time,
+                                                    time.monotonic() - start_time, reservation)
+                            response = None
+                            return stream
+                        await self.report_failure(target, 0)  # 首字节之前流已结束，视为连接错误
+                    else:
+                        response_data = await response.text()
+                        await self.report_failure(target, response.status, retry_after)
+                        logger.debug("Received error response from %s: %s", url, response_data)
+                        if response.status in CLIENT_ERROR_STATUSES:
+                            client_error = UpstreamError.from_text(response.status, response_data)
+                        if response.status not in [429, 500, 502, 503, 403]:
+                            break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    await self.report_failure(target, 0)
+                    logger.error("ClientError during streaming request to %s: %s", url, e,
+                                 extra={'target': target['id']})
+                finally:
+                    if response is not None:
+                        response.release()
+
+                if self.breakers[target['id']].state != 'closed':
+                    break  # 目标已熔断，不再在该目标上重试
+
+                await asyncio.sleep(target.get('retry_wait_time', 1))  # 重试前等待
+            self._settle_tokens(reservation, 0)  # 请求最终失败，释放预留
+            if client_error is not None:
+                raise client_error
+            return None
+        except asyncio.CancelledError:
+            self.breakers[target['id']].release()  # 请求被取消，不会有结果，归还试探名额
+            raise
+        finally:
+            if stream is None:
+                self._release_slot(target)
+
+    def _arm_wakeup(self, wake_at):
+        """
+        在指定时间唤醒等待队列；已有更早的定时器时不做处理
+        :param wake_at: 唤醒时间戳
+        """
+        if self._wakeup_handle is not None:
+            if self._wakeup_at <= wake_at:
+                return
+            self._wakeup_handle.cancel()
+        self._wakeup_at = wake_at
+        self._wakeup_handle = asyncio.get_running_loop().call_later(max(0, wake_at - time.time()), self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup_handle = None
+        self._notify_waiters()
+
+    def _notify_waiters(self):
+        """
+        安排一次等待队列的分发，同一时刻最多只有一个分发任务
+        """
+        if self._dispatch_task is None or self._dispatch_task.done():
+            self._dispatch_task = asyncio.get_running_loop().create_task(self._dispatch_waiters())
+
+    async def _dispatch_waiters(self):
+        """
+        按队列顺序把各模型分组的可用目标直接交给该分组中等待的请求（同时为其预留令牌），
+        没有可用目标时按最早可调度时间或 TPM 窗口最早能容纳预留的时间设置唤醒定时器
+        """
+        wake_times = []
+        for group in [group for group in self.groups.values() if group.waiters]:
+            waiters = group.waiters
+            while waiters:
+                if waiters[0][2].done():
+                    heapq.heappop(waiters)  # 已超时或已取消的等待者
+                    continue
+                target, reservation = await self._get_target_from(
+                    group, affinity_key=waiters[0][3], demand=waiters[0][4])
+                if target is None:
+                    if group.tokens_available_at is not None:
+                        wake_times.append(group.tokens_available_at)
+                    break
+                while waiters:
+                    _, _, future, _, _ = heapq.heappop(waiters)
+                    if not future.done():
+                        future.set_result((target, reservation))
+                        break
+                else:
+                    self._abandon_dispatch(target, reservation)  # 等待者已全部离开，放弃本次派发
+
+        if self.queue_depth:
+            # 就绪目标重新可用时 _schedule 会再次分发，这里只需等待冷却中的目标与 TPM 窗口
+            self._promote_ready(time.time())
+            wake_at = min(filter(None, (self._next_cooling_time(), *wake_times)), default=None)
+            if wake_at is not None:
+                self._arm_wakeup(wake_at)
+
+    async def _wait_for_target(self, deadline, group, affinity_key=None, demand=None):
         """
-        处理请求，选择目标并发送请求
+        进入模型分组的等待队列，直到分发到目标或超过截止时间
+        :param deadline: 截止时间（time.monotonic() 时间戳）
+        :param group: 请求所属的模型分组
+        :param affinity_key: 请求的前缀亲和键，轮到该请求时按它选择目标
+        :param demand: 令牌需求 (请求数据, 提示令牌数)，分发时按它预留令牌
+        :return: (分发到的目标服务器字典, TokenReservation)，超时或队列已满时返回 (None, None)
+        """
+        if self.max_queue_depth and self.queue_depth >= self.max_queue_depth:
+            logger.warning("Admission queue is full (%s waiting). Request rejected.", self.queue_depth)
+            return None, None
+
+        future = asyncio.get_running_loop().create_future()
+        key = deadline if self.queue_order == 'deadline' else time.monotonic()
+        heapq.heappush(group.waiters, (key, next(self._waiter_seq), future, affinity_key, demand))
+        self.queue_depth += 1
+        group.queue_depth += 1
+        try:
+            self._notify_waiters()
+            return await asyncio.wait_for(future, timeout=max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            return None, None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._abandon_dispatch(*future.result())  # 已分发到目标但调用方被取消
+            raise
+        finally:
+            self.queue_depth -= 1
+            group.queue_depth -= 1
+
+    def _hedge_delay(self, target):
+        """
+        获取目标触发对冲前的等待时间
+        :param target: 目标服务器字典
+        :return: 首字节延迟分位数（秒）；样本不足、预算不足或目标处于熔断试探时返回 None
+        """
+        tracker = self.latency[target['id']]
+        if len(tracker.ttfb_samples) < 10 or self._hedge_tokens < 1 or self.breakers[target['id']].state != 'closed':
+            return None
+        return tracker.percentile(self.hedge_percentile, 'ttfb')
+
+    async def _hedged_send(self, target, request_data, stream, token_count, reservation=None):
+        """
+        发送请求；超过首字节延迟分位数仍未收到首字节时向另一个目标发送副本，
+        采用先成功的响应并取消另一个请求。被取消的请求已发往上游，保留其 TPM 令牌预留。
+        :return: 先成功的响应，均失败时返回 None
+        """
+        self._hedge_tokens = min(self._hedge_tokens + self.hedge_budget, 10)
+        delay = self._hedge_delay(target)
+        first_byte = asyncio.Event()
+        primary = asyncio.create_task(
+            self.send_request(target, dict(request_data), stream, token_count, first_byte, reservation))
+        tasks = [primary]
+        try:
+            if delay is None:
+                return await primary
+
+            started = asyncio.create_task(first_byte.wait())
+            try:
+                await asyncio.wait({primary, started}, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                started.cancel()
+            if primary.done() or first_byte.is_set():
+                return await primary
+
+            group = self.resolve_model(request_data.get('model'))
+            hedge_target, hedge_reservation = await self._get_target_from(
+                group, {target['id']}, self._affinity_key(request_data), (request_data, token_count))
+            if hedge_target is None:
+                return await primary
+            if self.breakers[hedge_target['id']].state != 'closed':
+                self._abandon_dispatch(hedge_target, hedge_reservation)  # 不向熔断试探中的目标发送副本
+                return await primary
+            self._hedge_tokens -= 1
+            self.hedges_sent += 1
+            logger.debug("Hedging request to %s with %s after %.3fs.", target['id'], hedge_target['id'], delay)
+
+            hedge = asyncio.create_task(self.send_request(hedge_target, dict(request_data), stream, token_count,
+                                                          reservation=hedge_reservation))
+            tasks.append(hedge)
+            pending = {primary, hedge}
+            result = None
+            while pending and result is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response = task.result()
+                    if result is None:
+                        result = response
+                    elif isinstance(response, StreamResponse):
+                        await response.aclose()  # 两个请求同时完成时关闭多余的流
+            for task in pending:
+                self._discard_send(task)
+            await asyncio.gather(*pending, return_exceptions=True)
+            return result
+        except BaseException:
+            # 调用方被取消或出错：不再需要任何一个请求，取消仍在进行的请求并关闭已返回的流
+            for task in tasks:
+                self._discard_send(task)
+            raise
+
+    @staticmethod
+    def _discard_send(task):
+        """
+        取消不再需要的发送任务；任务已经（或在取消生效前）返回了流式响应时关闭该流，归还其并发名额
+        :param task: send_request 的任务
+        """
+        def close_stream(finished):
+            if not finished.cancelled() and finished.exception() is None \
+                    and isinstance(finished.result(), StreamResponse):
+                asyncio.ensure_future(finished.result().aclose())
+
+        task.cancel()
+        task.add_done_callback(close_stream)
+
+    async def process_request(self, request_data, stream=None, timeout=None):
+        """
+        处理请求，选择目标并发送请求；暂无可用目标时进入等待队列，在目标重新可用时被唤醒
         :param request_data: 请求的数据
-        :return: 目标服务器的响应
+        :param stream: 是否流式返回，缺省时按 request_data 中的 stream 字段决定
+        :param timeout: 等待可用目标的最长时间（秒），缺省为 max_wait_time
+        :return: 目标服务器的响应；流式时为可异步迭代 SSE 事件的 StreamResponse（或单飞模式下的 FlightSubscriber）
+        :raises UpstreamError: 上游以客户端错误拒绝了请求，不会改投其他目标
+        """
+        if stream is None:
+            stream = bool(request_data.get('stream'))
+        elif stream:
+            request_data['stream'] = True
+
+        if not self.single_flight or not ResponseCache.is_deterministic(request_data):
+            return await self._process_request(request_data, stream, timeout)  # 采样请求需要各自独立的结果
+
+        key = (canonical_request_key(request_data), stream)
+        flight = self.flights.get(key)
+        if flight is not None:
+            return await flight.join(copy_result=True)
+
+        def on_finish(finished):
+            if self.flights.get(key) is finished:
+                del self.flights[key]
+
+        flight = self.flights[key] = SingleFlight(self._process_request(request_data, stream, timeout), on_finish)
+        return await flight.join()
+
+    async def _process_request(self, request_data, stream, timeout):
+        """
+        处理单个请求：按模型确定候选分组，查询响应缓存、获取目标并发送，目标熔断时改投同一分组的其他目标
         """
-        total_wait_time = 0  # 初始化总等待时间
-        max_wait_time = 300  # 最大等待时间300秒
-        wait_interval = 1  # 每次重试间隔1秒
+        group = self.resolve_model(request_data.get('model'))
+        if group is None:
+            logger.error("No target serves model %s. Request rejected.", request_data.get('model'))
+            return None
 
-        while total_wait_time < max_wait_time:
-            target = await self.get_target()  # 获取目标服务器
+        cache_key = None
+        if self.response_cache is not None:
+            if self.response_cache.is_cacheable(request_data):
+                cache_key = canonical_request_key(request_data)
+                response = await self.response_cache.get(cache_key)
+                self.metrics.inc('lb_cache_requests_total', (('result', 'miss' if response is None else 'hit'),))
+                if response is not None:
+                    return response
+            else:
+                self.response_cache.skipped += 1
 
-            if target is not None:
-                if target.get('tpm_limit'):
-                    token_count = len(self.encoder.encode(str(request_data)))  # 计算请求的数据令牌数
-                    if sum(tokens for tokens, timestamp in self.token_counts[target['id']]
-                        if time.time() - timestamp <= 60) + token_count > target['tpm_limit']:
-                        logging.warning(f"TPM limit exceeded for target {target['id']}. Request not sent.")
-                        return None  # 如果令牌数超出限制，返回None
+        max_wait_time = self.max_wait_time if timeout is None else timeout
+        deadline = time.monotonic() + max_wait_time
 
-                return await self.send_request(target, request_data)  # 发送请求并返回响应
+        token_count = await self.token_counter.count(request_data)  # 每个请求只计算一次令牌数
+        affinity_key = self._affinity_key(request_data)
+        demand = (request_data, token_count)  # 选中目标时按提示令牌数 + max_tokens 预留 TPM 额度
 
-            # 如果未找到可用目标，等待1秒后重试
-            await asyncio.sleep(wait_interval)
-            total_wait_time += wait_interval
-            logging.warning(f"No available target found. Retrying in {wait_interval} seconds...")
+        for attempt in range(len(group.targets)):
+            # 分组中已有请求在排队时直接入队，保证先到先得；TPM 窗口容纳不下预留时同样入队等待
+            wait_start = time.monotonic()
+            target, reservation = (None, None) if group.queue_depth else \
+                await self._get_target_from(group, affinity_key=affinity_key, demand=demand)
+            if target is None:
+                target, reservation = await self._wait_for_target(deadline, group, affinity_key, demand)
+            self.metrics.observe('lb_queue_wait_seconds', time.monotonic() - wait_start)
+            if target is None:
+                logger.error("Failed to obtain a valid target within %s seconds. Aborting request.", max_wait_time)
+                return None
 
-        # 超过300秒未找到可用目标
-        logging.error(f"Failed to obtain a valid target after {total_wait_time} seconds. Aborting request.")
+            if self.hedge:
+                response = await self._hedged_send(target, request_data, stream, token_count, reservation)
+            else:
+                response = await self.send_request(target, request_data, stream, token_count,
+                                                   reservation=reservation)  # 发送请求并返回响应
+            if response is not None and cache_key is not None:
+                await self.response_cache.set(cache_key, response)
+            if response is not None or self.breakers[target['id']].state == 'closed':
+                return response
+            # 目标在请求过程中熔断，改投其他目标
+            logger.warning("Target %s tripped its circuit breaker. Rerouting request...", target['id'],
+                           extra={'target': target['id']})
         return None
 
 
+    @staticmethod
+    def _completed_batch_lines(output_path):
+        """
+        读取已有的输出文件，获取已成功完成的输入行号，用于断点续跑
+        :param output_path: 输出 JSONL 文件路径
+        :return: 已完成的行号集合
+        """
+        completed = set()
+        if not os.path.exists(output_path):
+            return completed
+        with open(output_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 中断时写了一半的行
+                if record.get('response') is not None:
+                    completed.add(record['line'])
+        return completed
+
+    async def process_batch(self, input_path, output_path, concurrency=10):
+        """
+        批量处理 JSONL 请求文件：逐行读取、有界并发发送，结果完成即追加写入输出 JSONL。
+        输出文件同时作为断点记录，重新运行时跳过已成功的行，失败的行会被重新发送。
+        输入的每行可以是请求体本身，也可以是 {"custom_id": ..., "body": {...}} 格式；
+        无法解析或不是 JSON 对象的行直接记录为失败，不影响其他行。
+        :param input_path: 输入 JSONL 文件路径
+        :param output_path: 输出 JSONL 文件路径，每行包含 line、custom_id、response、error
+        :param concurrency: 同时处理的请求数
+        :return: 统计信息字典
+        """
+        completed = self._completed_batch_lines(output_path)
+        stats = {'total': 0, 'skipped': 0, 'succeeded': 0, 'failed': 0}
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+
+        with open(output_path, 'a', encoding='utf-8') as output:
+            async def worker():
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    line_number, custom_id, request_data = item
+                    record = {'line': line_number, 'custom_id': custom_id, 'response': None, 'error': None}
+                    try:
+                        record['response'] = await self.process_request(request_data, stream=False)
+                        if record['response'] is None:
+                            record['error'] = 'Request failed'
+                    except Exception as e:
+                        record['error'] = str(e)
+                    stats['succeeded' if record['response'] is not None else 'failed'] += 1
+                    output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    output.flush()
+
+            def write_invalid(line_number, error):
+                stats['failed'] += 1
+                record = {'line': line_number, 'custom_id': None, 'response': None, 'error': error}
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                output.flush()
+
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+            try:
+                with open(input_path, 'r', encoding='utf-8') as f:
+                    for line_number, line in enumerate(f):
+                        if not line.strip():
+                            continue
+                        stats['total'] += 1
+                        if line_number in completed:
+                            stats['skipped'] += 1
+                            continue
+                        try:
+                            item = json.loads(line)
+                        except json.JSONDecodeError as e:
+                            write_invalid(line_number, f'Invalid JSON: {e}')
+                            continue
+                        if not isinstance(item, dict):
+                            write_invalid(line_number, 'Input line is not a JSON object')
+                            continue
+                        request_data = item['body'] if isinstance(item.get('body'), dict) else item
+                        request_data.pop('stream', None)
+                        await queue.put((line_number, item.get('custom_id'), request_data))
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+
+        logger.info("Batch finished: %s", stats)
+        return stats
+
+
+def load_config(path):
+    """
+    读取负载均衡器的 JSON 配置文件
+    :param path: 配置文件路径；文件内容可以是目标列表，也可以是包含 targets 及其他参数的字典
+    :return: 配置字典，至少包含 targets
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    if isinstance(config, list):
+        config = {'targets': config}
+    return config
+
+
+def _error_response(message, status, error_type='api_error'):
+    return web.json_response({'error': {'message': message, 'type': error_type}}, status=status)
+
+
+def create_gateway_app(lb, api_keys=None):
+    """
+    创建 OpenAI 兼容的 HTTP 网关应用，提供 /v1/chat/completions 与 /v1/models
+    :param lb: LoadBalancer 实例，随应用启动与关闭
+    :param api_keys: 允许访问网关的密钥列表，为空时不校验
+    :return: aiohttp.web.Application
+    """
+    api_keys = set(api_keys or [])
+
+    @web.middleware
+    async def auth_middleware(request, handler):
+        if api_keys:
+            token = request.headers.get('Authorization', '').replace('Bearer ', '', 1).strip()
+            if token not in api_keys:
+                return _error_response('Invalid API key', 401, 'invalid_request_error')
+        return await handler(request)
+
+    async def handle_models(request):
+        models = lb.models()
+        return web.json_response({
+            'object': 'list',
+            'data': [{'id': model, 'object': 'model', 'owned_by': 'oneapi-loadbalancer'} for model in models]
+        })
+
+    async def handle_chat_completions(request):
+        try:
+            request_data = await request.json()
+        except ValueError:  # 包括 JSON 格式错误与请求体不是合法的 UTF-8
+            return _error_response('Request body is not valid JSON', 400, 'invalid_request_error')
+        if not isinstance(request_data, dict) or not request_data.get('messages'):
+            return _error_response("'messages' is required", 400, 'invalid_request_error')
+        messages = request_data['messages']
+        if not isinstance(messages, list) or not all(isinstance(message, dict) for message in messages):
+            return _error_response("'messages' must be a list of message objects", 400, 'invalid_request_error')
+        if request_data.get('model') is not None and not isinstance(request_data['model'], str):
+            return _error_response("'model' must be a string", 400, 'invalid_request_error')
+        if lb.resolve_model(request_data.get('model')) is None:
+            return _error_response(f"The model '{request_data['model']}' does not exist", 404, 'model_not_found')
+
+        try:
+            result = await lb.process_request(request_data)
+        except UpstreamError as e:
+            if isinstance(e.body, dict):
+                return web.json_response(e.body, status=e.status)  # 原样转发上游的错误内容
+            return _error_response(e.body or 'Upstream rejected the request', e.status, 'invalid_request_error')
+        if result is None:
+            return _error_response('No upstream target is available', 503)
+        if isinstance(result, dict):
+            return web.json_response(result)
+
+        async with result:
+            response = web.StreamResponse(headers={
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                'Connection': 'keep-alive'
+            })
+            await response.prepare(request)
+            async for event in result:
+                await response.write(event)
+            await response.write_eof()
+            return response
+
+    async def balancer_context(app):
+        await lb.start()
+        yield
+        await lb.aclose()
+
+    app = web.Application(middlewares=[auth_middleware], client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/v1/chat/completions', handle_chat_completions)
+    app.router.add_get('/v1/models', handle_models)
+    app.router.add_get('/metrics', lb.handle_metrics)
+    app.cleanup_ctx.append(balancer_context)
+    return app
+
+
+def serve(config_path, host='0.0.0.0', port=5800):
+    """
+    以 HTTP 网关方式运行负载均衡器，运行期间修改配置文件中的 targets 会被热加载
+    :param config_path: JSON 配置文件路径
+    :param host: 监听地址
+    :param port: 监听端口
+    """
+    config = load_config(config_path)
+    api_keys = config.pop('api_keys', None)
+    targets = config.pop('targets')
+    config.setdefault('config_path', config_path)
+    lb = LoadBalancer(targets, **config)
+    web.run_app(create_gateway_app(lb, api_keys), host=host, port=port)
+
+
+async def run_batch(config_path, input_path, output_path, concurrency=10):
+    """
+    按配置文件创建负载均衡器并批量处理 JSONL 请求文件
+    :param config_path: JSON 配置文件路径
+    :param input_path: 输入 JSONL 文件路径
+    :param output_path: 输出 JSONL 文件路径
+    :param concurrency: 同时处理的请求数
+    :return: 统计信息字典
+    """
+    config = load_config(config_path)
+    config.pop('api_keys', None)
+    targets = config.pop('targets')
+    config.setdefault('config_path', config_path)
+    async with LoadBalancer(targets, **config) as lb:
+        return await lb.process_batch(input_path, output_path, concurrency)
+
 
 # 使用示例：执行并发测试
 async def main():
@@ -348,28 +3428,50 @@ async def main():
         # 添加更多的模型配置
     ]
 
-    lb = LoadBalancer(targets, algorithm='weighted_random')
-
-    # 创建20个任务，每个任务请求不同的数字
-    tasks = []
-    semaphore = asyncio.Semaphore(10)  # 并发限制为10
+    async with LoadBalancer(targets, algorithm='weighted_random') as lb:
+        # 创建20个任务，每个任务请求不同的数字
+        tasks = []
+        semaphore = asyncio.Semaphore(10)  # 并发限制为10
 
-    async def execute_request(request_data):
-        async with semaphore:
-            return await lb.process_request(request_data)
+        async def execute_request(request_data):
+            async with semaphore:
+                return await lb.process_request(request_data)
 
-    for i in range(1, 21):
-        request_data = {
-            "messages": [{"role": "user", "content": f"Please respond with the number {i}"}]
-        }
-        tasks.append(execute_request(request_data))
+        for i in range(1, 21):
+            request_data = {
+                "messages": [{"role": "user", "content": f"Please respond with the number {i}"}]
+            }
+            tasks.append(execute_request(request_data))
 
-    # 等待所有任务完成
-    results = await asyncio.gather(*tasks)
+        # 等待所有任务完成
+        results = await asyncio.gather(*tasks, return_exceptions=True)  # 上游拒绝的请求以 UpstreamError 返回
 
     # 打印每个响应的内容
     for index, response in enumerate(results, start=1):
-        logging.info(f"Response {index}: {response}")
+        logger.info("Response %s: %s", index, response)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='OneAPI 负载均衡器')
+    parser.add_argument('--log-level', default='INFO', help='日志等级，如 DEBUG、INFO、WARNING')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='日志格式')
+    parser.add_argument('--log-sample-interval', type=float, default=10,
+                        help='同类警告日志的最短输出间隔（秒），0 表示不采样')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help='以 OpenAI 兼容的 HTTP 网关方式运行')
+    serve_parser.add_argument('--config', required=True, help='JSON 配置文件路径')
+    serve_parser.add_argument('--host', default='0.0.0.0', help='监听地址')
+    serve_parser.add_argument('--port', type=int, default=5800, help='监听端口')
+    batch_parser = subparsers.add_parser('batch', help='批量处理 JSONL 请求文件，支持断点续跑')
+    batch_parser.add_argument('--config', required=True, help='JSON 配置文件路径')
+    batch_parser.add_argument('--input', required=True, help='输入 JSONL 文件路径')
+    batch_parser.add_argument('--output', required=True, help='输出 JSONL 文件路径（同时作为断点记录）')
+    batch_parser.add_argument('--concurrency', type=int, default=10, help='同时处理的请求数')
+    args = parser.parse_args()
+    configure_logging(args.log_level, args.log_format, args.log_sample_interval)
+
+    if args.command == 'serve':
+        serve(args.config, args.host, args.port)
+    elif args.command == 'batch':
+        asyncio.run(run_batch(args.config, args.input, args.output, args.concurrency))
+    else:
+        asyncio.run(main())
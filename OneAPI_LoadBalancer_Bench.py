@@ -0,0 +1,339 @@
+"""
+OneAPI 负载均衡器基准测试：在本机启动可配置延迟分布、429/5xx 注入与限流的 aiohttp 模拟上游，
+以固定请求速率驱动每种负载均衡算法，输出吞吐量、p50/p95/p99 延迟、429 比例与公平性（JSON）。
+
+用法：
+    python OneAPI_LoadBalancer_Bench.py --output bench.json
+    python OneAPI_LoadBalancer_Bench.py --scenario scenario.json --rate 100 --duration 30
+"""
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import logging
+import argparse
+import platform
+from collections import deque
+
+from aiohttp import web
+
+from OneAPI_LoadBalancer import LoadBalancer, configure_logging
+
+ALGORITHMS = ['round_robin', 'weighted_random', 'least_used', 'dynamic_least_load', 'lowest_latency', 'prefix_affinity']
+
+# 缺省场景：三个能力不同的上游，其中一个带尾延迟、一个会注入错误、一个有严格限流
+DEFAULT_SCENARIO = {
+    'seed': 42,
+    'rate': 50,  # 每秒发起的请求数
+    'duration': 10,  # 每种算法的压测时长（秒）
+    'timeout': 10,  # 单个请求等待可用目标的最长时间（秒）
+    'balancer': {
+        'approximate_tokens': True
+    },
+    'upstreams': [
+        {
+            'id': 'fast',
+            'weight': 2,
+            'latency': {'distribution': 'lognormal', 'median': 0.05, 'sigma': 0.3},
+            'target': {'rps_limit': 100, 'rpm_limit': 6000}
+        },
+        {
+            'id': 'slow-tail',
+            'weight': 1,
+            'latency': {'distribution': 'lognormal', 'median': 0.15, 'sigma': 0.8},
+            'error_rate_5xx': 0.02,
+            'target': {'rps_limit': 100, 'rpm_limit': 6000}
+        },
+        {
+            'id': 'rate-limited',
+            'weight': 1,
+            'latency': {'distribution': 'uniform', 'low': 0.03, 'high': 0.08},
+            'rps_limit': 10,
+            'error_rate_429': 0.01,
+            'target': {'rps_limit': 100, 'rpm_limit': 6000}
+        }
+    ]
+}
+
+# 生成的目标配置缺省关闭请求间隔限制，只保留场景显式给出的流控
+DEFAULT_TARGET = {
+    'mrr': 0,
+    'sri': 0,
+    '429_wait_time': 1,
+    '500_wait_time': 1,
+    '502_wait_time': 1,
+    '503_wait_time': 1,
+    'retry_wait_time': 0.1,
+    'latency_probe_interval': 0
+}
+
+
+def percentile(values, q):
+    """
+    最近秩法计算分位数
+    :param values: 已排序的数值列表
+    :param q: 分位数，取值 0~1
+    :return: 分位数值，列表为空时返回 None
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))
+    return values[index]
+
+
+def jain_fairness(values):
+    """
+    Jain 公平性指数：所有值相等时为 1，集中到单个值时为 1/n
+    :param values: 各目标的（按权重归一化后的）分配量
+    :return: 0~1 之间的指数，没有分配时返回 None
+    """
+    total = sum(values)
+    if not values or total == 0:
+        return None
+    return total * total / (len(values) * sum(value * value for value in values))
+
+
+class MockUpstream:
+    """
+    模拟 OpenAI 兼容的上游：按配置的分布产生延迟，按概率注入 429/5xx，并按滑动窗口执行每秒/每分钟限流
+    """
+
+    def __init__(self, config, rng):
+        """
+        :param config: 上游配置，包含 id、latency、error_rate_429、error_rate_5xx、rps_limit、rpm_limit
+        :param rng: random.Random 实例，保证可复现
+        """
+        self.id = config['id']
+        self.latency = config.get('latency', {'distribution': 'constant', 'value': 0.05})
+        self.error_rate_429 = config.get('error_rate_429', 0)
+        self.error_rate_5xx = config.get('error_rate_5xx', 0)
+        self.rps_limit = config.get('rps_limit')
+        self.rpm_limit = config.get('rpm_limit')
+        self.rng = rng
+        self.reset()
+
+    def reset(self):
+        """清空统计与限流窗口，在每种算法开始前调用"""
+        self.second_window = deque()
+        self.minute_window = deque()
+        self.stats = {'requests': 0, 'served': 0, 'rate_limited': 0, 'injected_429': 0, 'injected_5xx': 0}
+
+    def sample_latency(self):
+        """按配置的分布采样一次响应延迟（秒）"""
+        latency = self.latency
+        distribution = latency.get('distribution', 'constant')
+        if distribution == 'constant':
+            return latency.get('value', 0.05)
+        if distribution == 'uniform':
+            return self.rng.uniform(latency['low'], latency['high'])
+        if distribution == 'exponential':
+            return self.rng.expovariate(1 / latency['mean'])
+        if distribution == 'lognormal':
+            return self.rng.lognormvariate(math.log(latency['median']), latency.get('sigma', 0.5))
+        raise ValueError(f"Unknown latency distribution: {distribution}")
+
+    def _rate_limit_headers(self, current_time):
+        """按每分钟窗口生成 x-ratelimit-* 响应头"""
+        if self.rpm_limit is None:
+            return {}
+        remaining = max(0, self.rpm_limit - len(self.minute_window))
+        reset = 60 - (current_time - self.minute_window[0]) if self.minute_window else 0
+        return {
+            'x-ratelimit-limit-requests': str(self.rpm_limit),
+            'x-ratelimit-remaining-requests': str(remaining),
+            'x-ratelimit-reset-requests': f'{max(0.0, reset):.3f}s'
+        }
+
+    async def handle(self, request):
+        request_data = await request.json()
+        current_time = time.monotonic()
+        self.stats['requests'] += 1
+        while self.second_window and self.second_window[0] <= current_time - 1:
+            self.second_window.popleft()
+        while self.minute_window and self.minute_window[0] <= current_time - 60:
+            self.minute_window.popleft()
+
+        if self.rps_limit is not None and len(self.second_window) >= self.rps_limit:
+            self.stats['rate_limited'] += 1
+            retry_after = 1 - (current_time - self.second_window[0])
+            return web.json_response({'error': {'message': 'Rate limit exceeded', 'type': 'rate_limit_error'}},
+                                     status=429, headers={'Retry-After': f'{max(0.0, retry_after):.3f}',
+                                                          **self._rate_limit_headers(current_time)})
+        if self.rpm_limit is not None and len(self.minute_window) >= self.rpm_limit:
+            self.stats['rate_limited'] += 1
+            return web.json_response({'error': {'message': 'Rate limit exceeded', 'type': 'rate_limit_error'}},
+                                     status=429, headers=self._rate_limit_headers(current_time))
+        self.second_window.append(current_time)
+        self.minute_window.append(current_time)
+
+        await asyncio.sleep(self.sample_latency())
+
+        roll = self.rng.random()
+        if roll < self.error_rate_429:
+            self.stats['injected_429'] += 1
+            return web.json_response({'error': {'message': 'Injected rate limit', 'type': 'rate_limit_error'}},
+                                     status=429, headers={'Retry-After': '1'})
+        if roll < self.error_rate_429 + self.error_rate_5xx:
+            self.stats['injected_5xx'] += 1
+            return web.json_response({'error': {'message': 'Injected server error', 'type': 'api_error'}},
+                                     status=self.rng.choice([500, 502, 503]))
+
+        self.stats['served'] += 1
+        return web.json_response({
+            'id': f'chatcmpl-{self.id}-{self.stats["served"]}',
+            'object': 'chat.completion',
+            'model': request_data.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 1, 'total_tokens': 11}
+        }, headers=self._rate_limit_headers(current_time))
+
+
+async def start_upstreams(upstreams, host='127.0.0.1', port=0):
+    """
+    在同一个 aiohttp 应用中挂载所有模拟上游，路径为 /<id>/v1/chat/completions
+    :return: (AppRunner, 基础 URL)
+    """
+    app = web.Application()
+    for upstream in upstreams:
+        app.router.add_post(f'/{upstream.id}/v1/chat/completions', upstream.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}'
+
+
+async def run_algorithm(algorithm, scenario, upstreams, base_url):
+    """
+    以固定速率（开环）向负载均衡器发起请求，统计单个算法的结果
+    :param algorithm: 负载均衡算法名
+    :param scenario: 场景配置
+    :param upstreams: MockUpstream 列表
+    :param base_url: 模拟上游的基础 URL
+    :return: 结果字典
+    """
+    for upstream in upstreams:
+        upstream.reset()
+    targets = []
+    for upstream_config, upstream in zip(scenario['upstreams'], upstreams):
+        targets.append({
+            **DEFAULT_TARGET,
+            'id': upstream.id,
+            'weight': upstream_config.get('weight', 1),
+            'api_domain': f'{base_url}/{upstream.id}',
+            **upstream_config.get('target', {})
+        })
+
+    rate = scenario['rate']
+    total = int(rate * scenario['duration'])
+    latencies = []
+    outcomes = {'succeeded': 0, 'failed': 0}
+
+    async with LoadBalancer(targets, algorithm=algorithm, **scenario.get('balancer', {})) as lb:
+        async def one(index):
+            request_data = {'messages': [{'role': 'user', 'content': f'Benchmark request {index}'}]}
+            start_time = time.monotonic()
+            result = await lb.process_request(request_data, timeout=scenario.get('timeout'))
+            if result is None:
+                outcomes['failed'] += 1
+            else:
+                outcomes['succeeded'] += 1
+                latencies.append(time.monotonic() - start_time)
+
+        start_time = time.monotonic()
+        tasks = []
+        for index in range(total):
+            delay = start_time + index / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(one(index)))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start_time
+
+    latencies.sort()
+    upstream_requests = sum(upstream.stats['requests'] for upstream in upstreams)
+    upstream_429 = sum(upstream.stats['rate_limited'] + upstream.stats['injected_429'] for upstream in upstreams)
+    weights = {upstream_config['id']: upstream_config.get('weight', 1) for upstream_config in scenario['upstreams']}
+    served = {upstream.id: upstream.stats['served'] for upstream in upstreams}
+    return {
+        'algorithm': algorithm,
+        'requests': total,
+        'succeeded': outcomes['succeeded'],
+        'failed': outcomes['failed'],
+        'elapsed': round(elapsed, 3),
+        'throughput': round(outcomes['succeeded'] / elapsed, 3) if elapsed else None,
+        'latency': {
+            'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None
+        },
+        'upstream_requests': upstream_requests,
+        'upstream_429': upstream_429,
+        'rate_429': round(upstream_429 / upstream_requests, 4) if upstream_requests else None,
+        'fairness': jain_fairness([served[target_id] / weights[target_id] for target_id in served]),
+        'targets': {upstream.id: dict(upstream.stats) for upstream in upstreams}
+    }
+
+
+async def run_benchmark(scenario, algorithms=None):
+    """
+    启动模拟上游并依次压测各算法
+    :param scenario: 场景配置，缺省字段取 DEFAULT_SCENARIO
+    :param algorithms: 要压测的算法列表，缺省为全部算法
+    :return: 包含环境信息、场景与各算法结果的报告字典
+    """
+    scenario = {**DEFAULT_SCENARIO, **scenario}
+    algorithms = algorithms or scenario.get('algorithms') or ALGORITHMS
+    rng = random.Random(scenario.get('seed'))
+    upstreams = [MockUpstream(config, rng) for config in scenario['upstreams']]
+    runner, base_url = await start_upstreams(upstreams)
+    results = []
+    try:
+        for algorithm in algorithms:
+            random.seed(scenario.get('seed'))  # 加权随机等算法使用全局随机数
+            result = await run_algorithm(algorithm, scenario, upstreams, base_url)
+            logging.warning(f"{algorithm}: throughput={result['throughput']}/s p99={result['latency']['p99']} "
+                            f"429={result['rate_429']} fairness={result['fairness']}")
+            results.append(result)
+    finally:
+        await runner.cleanup()
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenario': scenario,
+        'results': results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='OneAPI 负载均衡器基准测试')
+    parser.add_argument('--scenario', help='场景 JSON 文件路径，缺省使用内置场景')
+    parser.add_argument('--algorithms', nargs='+', choices=ALGORITHMS, help='要压测的算法，缺省为全部')
+    parser.add_argument('--rate', type=float, help='每秒请求数，覆盖场景配置')
+    parser.add_argument('--duration', type=float, help='每种算法的压测时长（秒），覆盖场景配置')
+    parser.add_argument('--output', help='结果 JSON 文件路径，缺省输出到标准输出')
+    args = parser.parse_args()
+
+    configure_logging('WARNING')  # 压测时不输出逐请求的调试日志
+    scenario = {}
+    if args.scenario:
+        with open(args.scenario, 'r', encoding='utf-8') as f:
+            scenario = json.load(f)
+    if args.rate is not None:
+        scenario['rate'] = args.rate
+    if args.duration is not None:
+        scenario['duration'] = args.duration
+
+    report = asyncio.run(run_benchmark(scenario, args.algorithms))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()